@@ -0,0 +1,119 @@
+import csv  # For reading the alarm rules .csv file.
+import queue
+import threading
+from collections import namedtuple
+import numpy as np
+
+default_alarm_rules_file = r"C:\Users\Josh\Desktop\Work\BTS\alarmrules.csv"
+
+AlarmEvent = namedtuple('AlarmEvent', ['state', 'car_no', 'rule', 'register_name', 'value', 'timestamp'])  # state is 'raised' or 'cleared'.
+
+
+class AlarmEngine:
+    ''' Checks polled values against exceedance rules and queues raised/cleared events for the Viewer.
+
+        Rules are loaded from a .csv with the columns:
+        name, register, op_mode, low, high, hysteresis, debounce
+        - op_mode is the operation mode the rule applies in (blank or 0 for all modes)
+        - low/high are the limits, either may be blank for a one sided rule
+        - hysteresis is how far back inside the limits a value must come before the alarm clears
+        - debounce is the number of consecutive samples needed to raise or clear.
+        Rules are compiled into arrays at load so each batch is checked against all rules in one pass. '''
+
+    def __init__(self, alarm_rules_file=default_alarm_rules_file, operation_mode=0):
+        self.events = queue.SimpleQueue()  # AlarmEvent objects, drained by the Viewer.
+        self.__lock = threading.Lock()
+        self._open_alarm_rules_file(alarm_rules_file)
+        self.set_operation_mode(operation_mode)
+
+    def _open_alarm_rules_file(self, alarm_rules_file):
+        ''' Takes the alarm rules .csv and compiles it into per-rule arrays. '''
+        rule_names, registers, op_modes, lows, highs, hysteresis, debounce = [], [], [], [], [], [], []
+        with open(alarm_rules_file, encoding="utf-8-sig") as file:
+            rows = csv.DictReader(file)
+            for row in rows:
+                rule_names.append(row['name'])
+                registers.append(row['register'])
+                op_modes.append(int(row['op_mode'] or 0))
+                lows.append(float(row['low']) if row['low'] else -np.inf)
+                highs.append(float(row['high']) if row['high'] else np.inf)
+                hysteresis.append(float(row['hysteresis'] or 0))
+                debounce.append(max(int(row['debounce'] or 1), 1))
+        self.__rule_names = rule_names
+        self.__register_columns = {name: col for col, name in enumerate(dict.fromkeys(registers))}  # Register name and its column.
+        self.__rule_columns = np.array([self.__register_columns[name] for name in registers], dtype=np.int64)
+        self.__rule_registers = registers
+        self.__op_modes = np.array(op_modes, dtype=np.int64)
+        self.__raise_low = np.array(lows)
+        self.__raise_high = np.array(highs)
+        self.__clear_low = self.__raise_low + np.array(hysteresis)
+        self.__clear_high = self.__raise_high - np.array(hysteresis)
+        self.__debounce = np.array(debounce, dtype=np.int64)
+        self.__car_rows = dict()  # Car number and its row in the state arrays.
+        self.__active = np.zeros((0, len(rule_names)), dtype=bool)
+        self.__counter = np.zeros((0, len(rule_names)), dtype=np.int64)
+
+    def set_operation_mode(self, operation_mode):
+        ''' Enable only the rules for this operation mode (plus those for all modes). Resets alarm state. '''
+        with self.__lock:
+            self.operation_mode = int(operation_mode)
+            self.__enabled = (self.__op_modes == 0) | (self.__op_modes == self.operation_mode)
+            self.__active[:] = False
+            self.__counter[:] = 0
+
+    def __rows(self, car_nos):
+        for car_no in car_nos:
+            if car_no not in self.__car_rows:
+                self.__car_rows[car_no] = len(self.__car_rows)
+        if len(self.__car_rows) > len(self.__active):
+            extra = len(self.__car_rows) - len(self.__active)
+            self.__active = np.vstack([self.__active, np.zeros((extra, len(self.__rule_names)), dtype=bool)])
+            self.__counter = np.vstack([self.__counter, np.zeros((extra, len(self.__rule_names)), dtype=np.int64)])
+        return np.array([self.__car_rows[car_no] for car_no in car_nos], dtype=np.int64)
+
+    def check_many(self, car_nos, values_list, timestamp):
+        ''' Check one polled batch per car (values_list holds a register name/value dictionary for each car)
+            against every rule. Registers missing from a car's batch leave its rules unchanged. '''
+        register_values = np.full((len(car_nos), len(self.__register_columns)), np.nan)
+        for index, values in enumerate(values_list):
+            for register_name, value in values.items():
+                col = self.__register_columns.get(register_name)
+                if col is not None:
+                    register_values[index, col] = value
+        v = register_values[:, self.__rule_columns]  # Cars x rules
+        present = ~np.isnan(v) & self.__enabled
+        with self.__lock:
+            rows = self.__rows(car_nos)
+            active = self.__active[rows]
+            exceeded = (v > self.__raise_high) | (v < self.__raise_low)
+            inside = (v <= self.__clear_high) & (v >= self.__clear_low)
+            want_change = present & np.where(active, inside, exceeded)
+            counter = np.where(want_change, self.__counter[rows] + 1, np.where(present, 0, self.__counter[rows]))
+            flip = counter >= self.__debounce
+            active ^= flip
+            counter[flip] = 0
+            self.__active[rows] = active
+            self.__counter[rows] = counter
+        for index, rule in zip(*np.nonzero(flip)):
+            state = 'raised' if active[index, rule] else 'cleared'
+            self.events.put(AlarmEvent(state, car_nos[index], self.__rule_names[rule],
+                                       self.__rule_registers[rule], float(v[index, rule]), timestamp))
+
+    def check(self, car_no, group, values, timestamp):
+        ''' Check one polled sample, matching the Function sample callback signature. '''
+        self.check_many([car_no], [values], timestamp)
+
+    def drain_events(self):
+        ''' Return a list of all events queued since the last call. '''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def active_alarms(self):
+        ''' Return a list of (car_no, rule name) for every alarm currently raised. '''
+        with self.__lock:
+            return [(car_no, self.__rule_names[rule]) for car_no, row in self.__car_rows.items()
+                    for rule in np.nonzero(self.__active[row])[0]]
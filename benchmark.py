@@ -0,0 +1,88 @@
+''' Polling throughput benchmark against simulated Industruinos, so comms.py performance changes show up as numbers.
+    For each baudrate, number of cars and read method (one read per register or block reads) it reports
+    register values read per second, poll cycle latency percentiles and bus utilisation.
+    Run with: python benchmark.py [--register-map file] [--group rval] [--cycles 20] '''
+import argparse
+import csv
+import os
+import tempfile
+import time
+import numpy as np
+from comms import Communication
+from simulator import SimulatedBus, SimulatedSlave
+
+default_baud_rates = [9600, 19200, 38400, 115200]
+default_car_counts = [1, 2, 4, 8]
+
+
+def _write_csv(path, fieldnames, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _synthetic_register_map(path):
+    ''' Eight setpoint and eight live value registers, as a typical car. '''
+    rows = [{'name': 'SVAL_%d' % i, 'regno': i, 'group': 'sval'} for i in range(8)]
+    rows += [{'name': 'RVAL_%d' % i, 'regno': 100 + i, 'group': 'rval'} for i in range(8)]
+    _write_csv(path, ['name', 'regno', 'group'], rows)
+
+
+def run_case(register_map, serial_config, group, baudrate, car_count, batched, cycles, turnaround):
+    ''' Poll the group from every car for the number of cycles. Returns a dictionary of results. '''
+    bus = SimulatedBus()
+    comms = Communication(register_map=register_map, serial_config=serial_config, serial_factory=lambda port: bus)
+    names = comms.register_groups()[group]
+    for car_no in range(1, car_count + 1):
+        bus.add_slave(SimulatedSlave.from_register_map(car_no, register_map, turnaround=turnaround))
+        comms.add_device(car_no, car_no, 'SIM')
+    bus.baudrate = baudrate  # SerialBus sets the config file baudrate, override it per case.
+    cycle_times = []
+    start = time.perf_counter()
+    for _ in range(cycles):
+        cycle_start = time.perf_counter()
+        for car_no in range(1, car_count + 1):
+            if batched:
+                comms.read_group(car_no, group)
+            else:
+                for name in names:
+                    comms.data_request(car_no, name)
+        cycle_times.append(time.perf_counter() - cycle_start)
+    elapsed = time.perf_counter() - start
+    cycle_times = np.array(cycle_times) * 1000.0
+    return {'baudrate': baudrate, 'cars': car_count, 'method': 'block' if batched else 'single',
+            'reads_per_s': cycles * car_count * len(names) / elapsed,
+            'p50_ms': np.percentile(cycle_times, 50), 'p95_ms': np.percentile(cycle_times, 95),
+            'p99_ms': np.percentile(cycle_times, 99), 'utilisation': 100.0 * bus.busy_time / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--register-map', help='Register map .csv (a synthetic map is used if omitted)')
+    parser.add_argument('--group', default='rval', help='Register group to poll')
+    parser.add_argument('--cycles', type=int, default=20, help='Poll cycles per case')
+    parser.add_argument('--baud', type=int, nargs='+', default=default_baud_rates)
+    parser.add_argument('--cars', type=int, nargs='+', default=default_car_counts)
+    parser.add_argument('--turnaround', type=float, default=0.002, help='Slave turnaround time in seconds')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        register_map = args.register_map
+        if register_map is None:
+            register_map = os.path.join(folder, 'registermap.csv')
+            _synthetic_register_map(register_map)
+        serial_config = os.path.join(folder, 'serialconfig.csv')
+        _write_csv(serial_config, ['baudrate', 'no_bits', 'parity', 'stop_bits', 'timeout'],
+                   [{'baudrate': 19200, 'no_bits': 8, 'parity': 'N', 'stop_bits': 1, 'timeout': 0.1}])
+        print('%8s %5s %7s %12s %9s %9s %9s %6s' % ('baud', 'cars', 'method', 'reads/s', 'p50 ms', 'p95 ms', 'p99 ms', 'util'))
+        for baudrate in args.baud:
+            for car_count in args.cars:
+                for batched in (False, True):
+                    result = run_case(register_map, serial_config, args.group, baudrate, car_count,
+                                      batched, args.cycles, args.turnaround)
+                    print('%(baudrate)8d %(cars)5d %(method)7s %(reads_per_s)12.1f %(p50_ms)9.2f %(p95_ms)9.2f '
+                          '%(p99_ms)9.2f %(utilisation)5.1f%%' % result)
+
+
+if __name__ == '__main__':
+    main()
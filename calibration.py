@@ -0,0 +1,63 @@
+import json  # Calibration cache is stored as JSON.
+import os
+import threading
+
+''' Register map conventions for calibration:
+    - device_id_register holds a number unique to each Industruino
+    - checksum_register holds a checksum of the calibration table, changed by the device whenever it is recalibrated
+    - the calibration_group registers hold the table, <register name>_SCALE and <register name>_OFFSET
+      for each channel, e.g. BC_RVAL_SCALE and BC_RVAL_OFFSET calibrate BC_RVAL.
+    Scales are sent as unsigned integers of scale_divisor per unit (10000 = 1.0) and offsets as signed
+    16 bit integers in hundredths of a bar. '''
+
+default_calibration_cache_file = r"C:\Users\Josh\Desktop\Work\BTS\calibrationcache.json"
+device_id_register = 'DEVICE_ID'
+checksum_register = 'CAL_CHECKSUM'
+calibration_group = 'cal'
+scale_divisor = 10000
+offset_divisor = 100
+
+
+def parse_calibration_table(table):
+    ''' Takes a dictionary of calibration register name and raw value and returns a dictionary
+        of the calibrated register name and (scale, offset). A missing scale defaults to 1 and a missing offset to 0. '''
+    calibration = dict()
+    for name, raw in table.items():
+        if name.endswith('_SCALE'):
+            channel = name[:-len('_SCALE')]
+            scale, offset = calibration.get(channel, (1.0, 0.0))
+            calibration[channel] = (raw / scale_divisor, offset)
+        elif name.endswith('_OFFSET'):
+            channel = name[:-len('_OFFSET')]
+            scale, offset = calibration.get(channel, (1.0, 0.0))
+            signed = raw - 0x10000 if raw >= 0x8000 else raw
+            calibration[channel] = (scale, signed / offset_divisor)
+    return calibration
+
+
+class CalibrationCache:
+    ''' On-disk cache of raw calibration tables keyed by device id, each stored with the checksum it was read with.
+        The file is rewritten whole on every save via a temporary file, so it is never left half written. '''
+
+    def __init__(self, calibration_cache_file=default_calibration_cache_file):
+        self.calibration_cache_file = calibration_cache_file
+        self.__lock = threading.Lock()
+        self.__cache_dict = dict()
+        if os.path.exists(calibration_cache_file):
+            with open(calibration_cache_file, encoding='utf-8') as file:
+                self.__cache_dict = json.load(file)
+
+    def get(self, device_id, checksum):
+        ''' Return the cached raw table for the device if its checksum matches, otherwise None. '''
+        entry = self.__cache_dict.get(str(device_id))
+        if entry is None or entry['checksum'] != checksum:
+            return None
+        return entry['table']
+
+    def save(self, device_id, checksum, table):
+        with self.__lock:
+            self.__cache_dict[str(device_id)] = {'checksum' : checksum, 'table' : table}
+            temporary_file = self.calibration_cache_file + '.tmp'
+            with open(temporary_file, 'w', encoding='utf-8') as file:
+                json.dump(self.__cache_dict, file)
+            os.replace(temporary_file, self.calibration_cache_file)
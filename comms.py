@@ -1,10 +1,128 @@
-import serial
-import minimalmodbus
 import csv  # For reading the register map .csv file.
+import numpy as np  # Vectorised decoding of blocks of register values.
 import sys
+import os
+import glob  # Serial device discovery on Linux/macOS.
+import time
+import threading  # Per-bus locking so several cars/threads can share one RS485 port.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait  # Per-port workers for the asyncio client and parallel port probing.
+import config_cache
+from default import _parse_serial_config, default_register_map_file, default_serial_configuration  # Shared with the Viewer, which must not import this module to read them.
 
-default_register_map_file = r"C:\Users\Josh\Desktop\Work\BTS\registermap.csv"
-default_serial_configuration = r"C:\Users\Josh\Desktop\Work\BTS\serialconfig.csv"
+serial = None  # pySerial and minimalmodbus are imported on first use (see _import_serial) to keep them off the start up path.
+minimalmodbus = None
+
+max_block_registers = 125  # Modbus limit on the number of holding registers returned by one read (FC3).
+max_write_registers = 123  # Modbus limit on the number of holding registers set by one write (FC16).
+broadcast_address = 0  # Modbus broadcast slave address, every slave on the bus acts on the write and none reply.
+
+
+def decode_hi_lo(data):
+    ''' Takes the integer value from device and splits to hi/lo byte and then into float.
+        The hi byte is the whole number and the lo byte the hundredths, e.g. 0x0A17 = 10.23. '''
+    return (data >> 8) + (data & 0xFF) / 100
+
+
+def decode_raw(data):
+    ''' Registers without a decoder are returned as the raw integer value. '''
+    return data
+
+
+def decode_hi_lo_words(words):
+    ''' Vectorised decode_hi_lo over an array (or list) of raw 16 bit register values. Returns a float array. '''
+    words = np.asarray(words, dtype=np.int32)
+    return (words >> 8) + (words & 0xFF) / 100.0
+
+
+def _import_serial():
+    ''' Import pySerial and minimalmodbus into the module namespace if not already done. '''
+    global serial, minimalmodbus
+    if minimalmodbus is None:
+        import serial
+        import minimalmodbus
+
+
+def _parse_register_map(register_map_file):
+    ''' Parse and validate the register map .csv into (register dict, register groups dict).
+        Module level so that config_cache can store the compiled result. Decoders are not part of it,
+        they come from group_decoders in code and are looked up each time the map is opened. '''
+    register_dict = dict()  # Dict of register names and associated register number
+    register_groups_dict = dict()  # Dict of register names and which group they belong to
+    with open(register_map_file, encoding="utf-8-sig") as file:
+        rows = csv.DictReader(file)
+        for row in rows:
+            register_dict[row['name']] = int(row['regno'])
+            if row['group'] in register_groups_dict:
+                register_groups_dict[row['group']].append(row['name'])  # Need way of appending, not overwriting value.
+            else:
+                register_groups_dict[row['group']] = [row['name']]
+    return register_dict, register_groups_dict
+
+
+class DeviceOfflineError(IOError):
+    ''' Raised without touching the bus when a device's circuit breaker is open (see DeviceHealth). '''
+
+
+class DeviceHealth:
+    ''' Health of one device: adaptive timeout, failure count and circuit breaker.
+        The timeout follows the observed response latency, i.e. round trip time less the time the frames
+        take on the wire (smoothed latency plus four times its variation, as TCP does), bounded between
+        min_timeout and the serial config timeout. The wire time of each frame is added on top per transaction. After
+        failure_threshold consecutive failed transactions the breaker opens: the device is 'offline',
+        is skipped by polling and is only probed in the background, with the probe interval doubling
+        up to max_probe_interval until it answers again. '''
+
+    min_timeout = 0.02  # Seconds, never wait less than this for a reply.
+    failure_threshold = 3
+    probe_interval = 2.0  # Seconds between probes of an offline device, doubled after each failed probe.
+    max_probe_interval = 30.0
+
+    def __init__(self, max_timeout):
+        self.max_timeout = max_timeout
+        self.timeout = max_timeout
+        self.srtt = None  # Smoothed round trip time.
+        self.rttvar = 0.0
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.online = True
+        self.next_probe = 0.0  # time.monotonic() at which an offline device is next probed.
+        self.__probe_interval = DeviceHealth.probe_interval
+
+    def record_success(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, DeviceHealth.min_timeout), self.max_timeout)
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.online = True
+        self.__probe_interval = DeviceHealth.probe_interval
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.timeout = self.max_timeout  # Back off to the full timeout until the device answers again.
+        if self.online and self.consecutive_failures >= DeviceHealth.failure_threshold:
+            self.online = False
+            self.next_probe = time.monotonic() + self.__probe_interval
+        elif not self.online:
+            self.__probe_interval = min(self.__probe_interval * 2, DeviceHealth.max_probe_interval)
+            self.next_probe = time.monotonic() + self.__probe_interval
+
+    def as_dict(self):
+        return {'online' : self.online, 'timeout' : self.timeout, 'srtt' : self.srtt,
+                'consecutive_failures' : self.consecutive_failures, 'successes' : self.successes,
+                'failures' : self.failures}
+
+
+# Decoder used for each register group. Future parsing can be added by adding a group and decoder here.
+group_decoders = {'sval' : decode_hi_lo,
+                  'rval' : decode_hi_lo}
 
 class Communication:
     '''Class serves following functions:
@@ -16,9 +134,25 @@ class Communication:
         ''' Creates the device dictionary of instrument objects to be associated with this instance of the Communication class.
 
             Populates the register map and serial configuration for this object either based
-            on default files, or if provided as keyword arguments, the provided map/config files. '''
+            on default files, or if provided as keyword arguments, the provided map/config files.
+            gap_tolerance (optional) is the number of unused registers a block read may span
+            in order to merge two requested registers into a single transaction.
+            max_retries (optional) is how many times a transaction with no/invalid response is retried.
+            metrics (optional) is a metrics.Metrics object to record latencies and error counts in. '''
         self.__device_dict = dict()
+        self.__health_dict = dict()  # Dict of car number and its DeviceHealth.
+        self.__pending_writes = dict()  # Write-behind queue, dict of (car number, register name) and latest value.
+        self.__pending_lock = threading.Lock()
+        self.__calibration_dict = dict()  # Dict of car number and ({register name: (scale, offset)}, its arrays per block plan).
+        self.__compiled_register_map = None
+        self.__bus_manager = None
+        self._serial_config_dict = None
+        self.__probe_thread = None  # Set while a probe thread is running, only changed under __probe_lock.
+        self.__probe_lock = threading.Lock()
         self.dude = 'Dummy'
+        self.gap_tolerance = kwargs.get('gap_tolerance', 0)
+        self.max_retries = kwargs.get('max_retries', 1)
+        self.metrics = kwargs.get('metrics')  # None disables instrumentation.
         # If the optional arguments for register_map or serial_config file paths are provided.
         if 'register_map' in kwargs:
             self._open_register_map_file(kwargs['register_map'])
@@ -28,132 +162,703 @@ class Communication:
             self._open_serial_config_file(kwargs['serial_config'])
         else:
             self._open_serial_config_file(default_serial_configuration)
+        # A bus manager may be shared between Communication objects so a port is only ever opened once.
+        # serial_factory (optional) creates the serial object for a port, e.g. a simulated bus for testing.
+        if 'bus_manager' in kwargs:
+            self.__bus_manager = kwargs['bus_manager']
+        else:
+            self.__bus_manager = BusManager(self._serial_config_dict, kwargs.get('serial_factory'))
             
     def add_device(self, car_no, slave_addr, com_port):
-        '''Method to create a new instrument object (adding a new Industruino)
-        to communicate with. This is added to the device dictionary. '''
-        self.__device_dict[car_no] = minimalmodbus.Instrument(com_port, slave_addr, minimalmodbus.MODE_RTU, close_port_after_each_call=True)
-        self.__device_dict[car_no].serial.baudrate = self.__serial_config_dict['baudrate']
-        self.__device_dict[car_no].serial.stopbits = self.__serial_config_dict['stop_bits']
-        self.__device_dict[car_no].serial.timeout = self.__serial_config_dict['timeout']
+        '''Method to add a new Industruino to communicate with. The device is stored in the device
+        dictionary as the shared bus for its COM port along with its slave address. '''
+        self.__health_dict[car_no] = DeviceHealth(self._serial_config_dict['timeout'])
+        self.__device_dict[car_no] = (self.__bus_manager.get_bus(com_port), slave_addr, self.__health_dict[car_no])
+
+    def device_port(self, car_no):
+        '''Return the COM port the given car is connected on, used to schedule polling per bus. '''
+        bus, slave_addr, health = self.__device_dict[car_no]
+        return bus.com_port
+
+    def device_online(self, car_no):
+        '''Return False while the car's circuit breaker is open, so pollers can skip it. '''
+        return self.__health_dict[car_no].online
+
+    def device_health(self):
+        '''Return a dictionary of car number and its health (online, timeout, srtt, failure counts) for the Viewer. '''
+        return {car_no: health.as_dict() for car_no, health in self.__health_dict.items()}
+
+    def register_groups(self):
+        '''Return a dictionary of each register group and the list of register names it contains. '''
+        return {group: list(names) for group, names in self.__register_groups_dict.items()}
 
     def _open_register_map_file(self, register_map_file):
         ''' Takes the register map .csv, parses and enters into the register dictionary.
             this dictionary has the name of the register as the key and register no. as value.
             This allows the register map to be rearranged or appended and the register can still be identified
             by its name e.g. PB_RVAL as opposed to the register number. '''
-        self.__register_dict = dict()  # Dict of register names and associated register number
-        self.__register_groups_dict = dict()  # Dict of register names and which group they belong to
-        with open(register_map_file, encoding="utf-8-sig") as file:
-            rows = csv.DictReader(file)
-            for row in rows:
-                self.__register_dict[row['name']] = int(row['regno'])
-                if row['group'] in self.__register_groups_dict:
-                    self.__register_groups_dict[row['group']].append(row['name'])  # Need way of appending, not overwriting value.
-                else:
-                    self.__register_groups_dict[row['group']] = [row['name']]
+        self.register_map_file = register_map_file
+        compiled = config_cache.load(register_map_file, _parse_register_map)
+        if compiled is self.__compiled_register_map:
+            return  # Unchanged, keep the block plans and calibration arrays already worked out.
+        self.__compiled_register_map = compiled
+        self.__register_dict, self.__register_groups_dict = compiled
+        self.__decoder_dict = {name: group_decoders.get(group, decode_raw)
+                               for group, names in self.__register_groups_dict.items() for name in names}
+        self.__plan_cache = dict()  # Block read plans already worked out, see __compiled_plan.
+        self.__calibration_dict = {car_no: (calibration, dict()) for car_no, (calibration, arrays) in self.__calibration_dict.items()}
 
     def _open_serial_config_file(self, serial_config_file):
         ''' Takes the serial configuration .csv and enters into the serial config dictionary.
             These values are used when creating each new serial object.
             Also allows for potential in future for differing baudrate based on priority by different Communication objects. '''
-        self._serial_config_dict = dict()
-        with open(serial_config_file, encoding="utf-8-sig") as file:
-            rows = csv.DictReader(file)
-            for row in rows:
-                self._serial_config_dict['baudrate'] = int(row['baudrate'])
-                self._serial_config_dict['no_bits'] = int(row['no_bits'])
-                self._serial_config_dict['parity'] = row['parity']
-                self._serial_config_dict['stop_bits'] = int(row['stop_bits'])
-                self._serial_config_dict['timeout'] = float(row['timeout'])
+        self.serial_config_file = serial_config_file
+        serial_config_dict = config_cache.load(serial_config_file, _parse_serial_config)
+        if self._serial_config_dict is None:
+            self._serial_config_dict = dict(serial_config_dict)
+        elif serial_config_dict != self._serial_config_dict:
+            self._serial_config_dict.update(serial_config_dict)  # Updated in place as the bus manager shares this dictionary.
+            if self.__bus_manager is not None:
+                self.__bus_manager.reconfigure()
+
+    def reload_configs(self, **kwargs):
+        ''' Re-read the register map and serial config, either the same files or the register_map and
+            serial_config paths given. Unchanged files come straight from the config cache and leave the
+            compiled state alone; a changed serial config is applied to the open buses. '''
+        self._open_register_map_file(kwargs.get('register_map', self.register_map_file))
+        self._open_serial_config_file(kwargs.get('serial_config', self.serial_config_file))
 
     def data_request(self, car_no, register_name):
         '''Public method to allow for Viewer/periodic checker to request specific data from a/many end devices.
         Takes the register name and then finds the correct register no for reading. '''
+        if self.metrics is not None:
+            call_start = time.perf_counter()
         register_no = self.__register_dict[register_name]
         device = self.__device_dict[car_no]
         data = self.__read_holding_reg(register_no, device)
         value_read = self.__message_parse(data, register_name)
+        calibration = self.__calibration_dict.get(car_no)
+        if calibration is not None and register_name in calibration[0]:
+            scale, offset = calibration[0][register_name]
+            value_read = value_read * scale + offset
+        if self.metrics is not None:
+            self.metrics.observe('comms_call_seconds', time.perf_counter() - call_start, call='data_request')
         return value_read
 
+    def data_request_many(self, car_no, register_names):
+        '''Public method to read several registers from one end device with as few transactions as possible.
+        The register numbers are grouped into contiguous blocks (see _plan_block_reads), each block is read
+        in one request and the result is split back out into a dictionary of register name and parsed value. '''
+        device = self.__device_dict[car_no]
+        key = (tuple(register_names), self.gap_tolerance)
+        blocks, names, hi_lo_mask, raw_indices = self.__compiled_plan(key)
+        words = []
+        for start, count, members in blocks:
+            data = self.__read_holding_regs(start, count, device)
+            words.extend(data[offset] for register_name, offset in members)
+        if self.metrics is not None:
+            decode_start = time.perf_counter()
+        values = self.__decode_masked(words, hi_lo_mask)
+        calibration = self.__calibration_dict.get(car_no)
+        if calibration is not None:
+            scales, offsets, raw_indices = self.__calibration_for(calibration, key, names, raw_indices)
+            values = values * scales + offsets
+        values = values.tolist()
+        for index in raw_indices:
+            values[index] = words[index]  # Undecoded registers stay integers, as from data_request.
+        values_read = dict(zip(names, values))
+        if self.metrics is not None:
+            self.metrics.observe('comms_decode_seconds', time.perf_counter() - decode_start)
+        return values_read
+
+    def set_calibration(self, car_no, calibration):
+        '''Public method to apply a car's calibration, a dictionary of register name and (scale, offset),
+        to every value read from it from now on. An empty dictionary removes the calibration.
+        Safe to call while polling: a new dictionary is swapped in whole, so a read in progress
+        finishes with the calibration it started with. '''
+        calibration_dict = dict(self.__calibration_dict)
+        if calibration:
+            calibration_dict[car_no] = (dict(calibration), dict())
+        else:
+            calibration_dict.pop(car_no, None)
+        self.__calibration_dict = calibration_dict
+
+    def __calibration_for(self, calibration, key, names, raw_indices):
+        ''' Scale and offset arrays lined up with a block plan's names, and the plan's undecoded registers
+            that have no calibration, precomputed once per car and plan. calibration is the car's entry
+            in __calibration_dict, which holds the arrays so they are replaced along with it. '''
+        calibration, calibration_arrays = calibration
+        arrays = calibration_arrays.get(key)
+        if arrays is None:
+            scales = np.array([calibration.get(name, (1.0, 0.0))[0] for name in names])
+            offsets = np.array([calibration.get(name, (1.0, 0.0))[1] for name in names])
+            raw_indices = [index for index in raw_indices if names[index] not in calibration]
+            arrays = calibration_arrays[key] = (scales, offsets, raw_indices)
+        return arrays
+
+    def decode_words(self, register_names, words):
+        '''Public method to decode many raw register values in one vectorised operation,
+        e.g. the same register from every car in a unit. register_names and words are equal length sequences.
+        Returns a float array in the same order, undecoded registers included as floats. '''
+        hi_lo_mask = np.fromiter((self.__decoder_dict[name] is decode_hi_lo for name in register_names),
+                                 dtype=bool, count=len(register_names))
+        return self.__decode_masked(words, hi_lo_mask)
+
+    def __decode_masked(self, words, hi_lo_mask):
+        words = np.asarray(words, dtype=np.int32)
+        return np.where(hi_lo_mask, decode_hi_lo_words(words), words)
+
+    def __compiled_plan(self, key):
+        ''' Returns the block plan for the registers, the register names in the order their values are
+            collected from the blocks, the matching hi/lo decode mask and the positions of undecoded registers.
+            Cached per key of (register names, gap tolerance) so repeated polls of the same group skip planning entirely. '''
+        if key not in self.__plan_cache:
+            blocks = self._plan_block_reads(key[0])
+            names = [register_name for start, count, members in blocks for register_name, offset in members]
+            hi_lo_mask = np.array([self.__decoder_dict[name] is decode_hi_lo for name in names], dtype=bool)
+            self.__plan_cache[key] = (blocks, names, hi_lo_mask, np.flatnonzero(~hi_lo_mask).tolist())
+        return self.__plan_cache[key]
+
+    def read_group(self, car_no, group):
+        '''Public method to read every register of a group (e.g. 'sval' or 'rval') from one end device. '''
+        return self.data_request_many(car_no, self.__register_groups_dict[group])
+
+    def _plan_block_reads(self, register_names):
+        ''' Works out the minimal set of contiguous block reads covering the requested registers.
+            Registers are sorted by number and a new block is started whenever the gap to the
+            previous register exceeds the gap tolerance, or the block would exceed max_block_registers.
+            Returns a list of (start register, register count, [(register name, offset in block), ...]). '''
+        registers = sorted((self.__register_dict[name], name) for name in set(register_names))
+        blocks = []
+        for register_no, register_name in registers:
+            if blocks:
+                start, count, members = blocks[-1]
+                gap = register_no - (start + count)
+                if gap <= self.gap_tolerance and (register_no - start) < max_block_registers:
+                    new_count = max(count, register_no - start + 1)
+                    members.append((register_name, register_no - start))
+                    blocks[-1] = (start, new_count, members)
+                    continue
+            blocks.append((register_no, 1, [(register_name, 0)]))
+        return blocks
+
     def __read_holding_reg(self, register, device):
         ''' Send a register request to interrogate Industruino device.
             Can also be used in a 'Maintenance mode' as a way of interrogating
             the devices with specific binary messages. '''
-        data = device.read_register(register, 0)
+        data = self.__transact(device, 'read_register', register, 0)
         return data
 
+    def __read_holding_regs(self, start_register, register_count, device):
+        ''' Send a single request for a contiguous block of registers (FC3).
+            Returns a list of the raw 16 bit register values in register order. '''
+        data = self.__transact(device, 'read_registers', start_register, register_count)
+        return data
+
+    def __transact(self, device, method_name, *args, probe=False):
+        ''' Carry out one transaction with the device's adaptive timeout, retrying up to max_retries times
+            when there is no or an invalid response, and update its health.
+            Raises DeviceOfflineError straight away if the device is offline (unless this is a probe). '''
+        bus, slave_addr, health = device
+        if not health.online and not probe:
+            raise DeviceOfflineError('Device at address %s on %s is offline' % (slave_addr, bus.com_port))
+        wire_time = self.__wire_time(method_name, *args)
+        metrics = self.metrics
+        for attempt in range(self.max_retries + 1):
+            wait_start = time.perf_counter()
+            with bus.lock:  # Held here so time spent waiting for other devices on the bus is not counted as latency.
+                start = time.perf_counter()
+                try:
+                    result = bus.execute(slave_addr, method_name, *args, timeout=health.timeout + wire_time)
+                except minimalmodbus.SlaveReportedException:
+                    health.record_success(max(time.perf_counter() - start - wire_time, 0.0))  # The device answered, the request was refused.
+                    if metrics is not None:
+                        self.__record_transaction(bus, slave_addr, method_name, wait_start, start, 'exception')
+                    raise
+                except minimalmodbus.MasterReportedException as error:
+                    if metrics is not None:
+                        kind = 'timeout' if isinstance(error, minimalmodbus.NoResponseError) else 'crc'
+                        self.__record_transaction(bus, slave_addr, method_name, wait_start, start, kind)
+                    if attempt < self.max_retries:
+                        continue
+                    health.record_failure()
+                    self.__start_probing()
+                    raise
+                except (OSError, serial.SerialException):
+                    if metrics is not None:
+                        self.__record_transaction(bus, slave_addr, method_name, wait_start, start, 'serial')
+                    health.record_failure()
+                    self.__start_probing()
+                    raise
+            health.record_success(max(time.perf_counter() - start - wire_time, 0.0))
+            if metrics is not None:
+                self.__record_transaction(bus, slave_addr, method_name, wait_start, start, None)
+            return result
+
+    def __record_transaction(self, bus, slave_addr, method_name, wait_start, start, error_kind):
+        ''' Record one transaction's bus wait and latency per port and per device, and any error by kind
+            (timeout: no response, crc: invalid response, exception: slave refused the request, serial: port error). '''
+        end = time.perf_counter()
+        port, slave = str(bus.com_port), str(slave_addr)
+        self.metrics.observe('modbus_bus_wait_seconds', start - wait_start, port=port)
+        self.metrics.observe('modbus_transaction_seconds', end - start, port=port, slave=slave, function=method_name)
+        self.metrics.increment('modbus_transactions_total', port=port, slave=slave)
+        if error_kind is not None:
+            self.metrics.increment('modbus_errors_total', port=port, slave=slave, kind=error_kind)
+
+    def __wire_time(self, method_name, *args):
+        ''' Seconds the request and response frames of a transaction take on the wire at the configured baudrate. '''
+        config = self._serial_config_dict
+        character_time = (1 + config['no_bits'] + (config['parity'] != 'N') + config['stop_bits']) / config['baudrate']
+        if method_name == 'read_registers':
+            frame_bytes = 8 + 5 + 2 * args[1]
+        elif method_name == 'write_registers':
+            frame_bytes = 9 + 2 * len(args[1]) + 8
+        else:
+            frame_bytes = 8 + 8
+        return frame_bytes * character_time
+
+    def __start_probing(self):
+        with self.__probe_lock:
+            if self.__probe_thread is None:
+                self.__probe_thread = threading.Thread(target=self.__probe_offline_devices, name='device-probe', daemon=True)
+                self.__probe_thread.start()
+
+    def __probe_offline_devices(self):
+        ''' Background thread which reads the lowest register of each offline device when its probe is due,
+            bringing it back into the poll rotation once it answers. Exits when every device is online; the
+            final check is made under the probe lock so a device going offline meanwhile either is seen here
+            or starts a new probe thread. '''
+        probe_register = min(self.__register_dict.values())
+        while True:
+            offline = [device for device in list(self.__device_dict.values()) if not device[2].online]
+            if not offline:
+                with self.__probe_lock:
+                    if all(device[2].online for device in list(self.__device_dict.values())):
+                        self.__probe_thread = None
+                        return
+                continue
+            now = time.monotonic()
+            for device in offline:
+                if device[2].next_probe <= now:
+                    try:
+                        self.__transact(device, 'read_register', probe_register, 0, probe=True)
+                    except (OSError, serial.SerialException):
+                        pass
+            time.sleep(min(DeviceHealth.probe_interval, 0.5))
+
     def __message_parse(self, data, register_name):
-        ''' Parse the message received after reading a register.
-            Future parse can be added with this method by simply adding an elif statement. '''
-        for group, names in self.__register_groups_dict.items():
-            for name in names:
-                if register_name == name:
-                    member_group = group
-        # Takes the integer value from device and splits to hi/lo byte and then into float.
-        if member_group == 'sval' or member_group == 'rval':
-            if data > 255:  # 3Chars or more
-                hi_byte = (hex(data)[2:-2])  # Slice data into a hex based on first byte
-                hi_byte = int(hi_byte, 16)  # Turn hex string into int, 2 nd arg is base of 16
-                lo_byte = (hex(data)[-2:])  # Slice data for last 2 chars
-                lo_byte = int(lo_byte, 16)
-            elif data < 255 and data > 0:  # 2 Chars or less
-                hi_byte = 0
-                lo_byte = (hex(data)[2:])  # Read either 1 or 2 chars after '0x'
-                lo_byte = int(lo_byte, 16)
-            value_read = hi_byte + (lo_byte/100)
+        ''' Parse the message received after reading a register using the decoder compiled for it
+            at register map load. Future parse can be added by adding a decoder to group_decoders. '''
+        value_read = self.__decoder_dict[register_name](data)
         return value_read
 
     def data_set(self, car_no, register_name, setting_value):
         ''' Public method to allow for Viewer to set holding register of a/many end devices. '''
+        if self.metrics is not None:
+            call_start = time.perf_counter()
         register_no = self.__register_dict[register_name]
         device = self.__device_dict[car_no]
         write_success = self.__set_holding_reg(register_no, device, setting_value)
         if write_success == False:
             pass  # Display something to indicate nonresponse. To be implemented later.
+        if self.metrics is not None:
+            self.metrics.observe('comms_call_seconds', time.perf_counter() - call_start, call='data_set')
+        return write_success
+
+    def data_set_many(self, car_no, settings):
+        ''' Public method to set several holding registers of one end device, settings being a dictionary of
+            register name and value. Registers with consecutive numbers are written in a single FC16 request.
+            Returns True if every write succeeded. '''
+        device = self.__device_dict[car_no]
+        write_success = True
+        for start, values in self._plan_block_writes(settings):
+            write_success &= self.__set_holding_regs(start, values, device)
+        return write_success
+
+    def data_set_unit(self, car_nos, settings, broadcast=False):
+        ''' Public method to push the same setpoints to every car in a unit. Returns a dictionary of
+            car number and write success.
+            With broadcast, each block is sent once to address 0 on every COM port where car_nos covers all the
+            cars added on that port, so a unit-wide change costs one transaction per bus. Every slave on a bus acts
+            on a broadcast, so ports with other cars added get per car writes instead; slaves that were never
+            added cannot be checked for, so only broadcast on a bus holding just this unit. Broadcasts are never
+            answered, so success for those cars only means the request was sent; a car whose circuit breaker is
+            open (see DeviceHealth) is reported False, as it cannot be assumed to have received it. '''
+        if not broadcast:
+            return {car_no: self.data_set_many(car_no, settings) for car_no in car_nos}
+        buses = dict()
+        for car_no in car_nos:
+            bus = self.__device_dict[car_no][0]
+            buses.setdefault(bus.com_port, (bus, set()))[1].add(car_no)
+        results = dict()
+        for bus, bus_cars in buses.values():
+            if any(device[0] is bus and car_no not in bus_cars for car_no, device in self.__device_dict.items()):
+                for car_no in bus_cars:  # A broadcast would also write cars that were not asked for.
+                    results[car_no] = self.data_set_many(car_no, settings)
+                continue
+            bus_success = True
+            for start, values in self._plan_block_writes(settings):
+                try:
+                    self.__broadcast(bus, 'write_registers', start, values)
+                except (OSError, ValueError, TypeError):
+                    bus_success = False
+            for car_no in bus_cars:
+                results[car_no] = bus_success and self.device_online(car_no)
+        return results
+
+    def __broadcast(self, bus, method_name, *args):
+        ''' Send one request to broadcast_address under the bus lock, recording it in metrics as __transact does.
+            No slave answers, so there is no retry and no device health to update. '''
+        wait_start = time.perf_counter()
+        with bus.lock:
+            start = time.perf_counter()
+            try:
+                bus.execute(broadcast_address, method_name, *args)
+            except (OSError, serial.SerialException):
+                if self.metrics is not None:
+                    self.__record_transaction(bus, broadcast_address, method_name, wait_start, start, 'serial')
+                raise
+        if self.metrics is not None:
+            self.__record_transaction(bus, broadcast_address, method_name, wait_start, start, None)
+
+    def queue_set(self, car_no, register_name, setting_value):
+        ''' Queue a setpoint write for the next flush_writes. A later write to the same register of the
+            same car replaces the queued value, so only the latest value is ever sent. '''
+        with self.__pending_lock:
+            self.__pending_writes[(car_no, register_name)] = setting_value
+
+    def flush_writes(self, broadcast=False):
+        ''' Send all queued writes, combined per car into block writes. If broadcast and every queued car has
+            the same settings, they are sent with data_set_unit broadcast instead (which only broadcasts
+            on ports where the queued cars are every car added there).
+            Returns a dictionary of car number and write success. '''
+        with self.__pending_lock:
+            pending, self.__pending_writes = self.__pending_writes, dict()
+        settings_by_car = dict()
+        for (car_no, register_name), setting_value in pending.items():
+            settings_by_car.setdefault(car_no, dict())[register_name] = setting_value
+        if not settings_by_car:
+            return dict()
+        all_settings = list(settings_by_car.values())
+        if broadcast and all(settings == all_settings[0] for settings in all_settings):
+            return self.data_set_unit(list(settings_by_car), all_settings[0], broadcast=True)
+        return {car_no: self.data_set_many(car_no, settings) for car_no, settings in settings_by_car.items()}
+
+    def _plan_block_writes(self, settings):
+        ''' Groups the settings (dictionary of register name and value) into runs of consecutive register
+            numbers, no longer than max_write_registers. Unlike reads no gaps are allowed, as a gap
+            would overwrite a register that was not asked for. Returns a list of (start register, [values]). '''
+        registers = sorted((self.__register_dict[name], value) for name, value in settings.items())
+        blocks = []
+        for register_no, value in registers:
+            if blocks:
+                start, values = blocks[-1]
+                if register_no == start + len(values) and len(values) < max_write_registers:
+                    values.append(value)
+                    continue
+            blocks.append((register_no, [value]))
+        return blocks
 
     def __set_holding_reg(self, register_no, device, setting_value):
         ''' Send message for setting a holding register value. '''
         try:
-            device.write_register(register_no, setting_value, 0)  # Final parameter must be 0 (dp) or sends float and nothing works!
+            self.__transact(device, 'write_register', register_no, setting_value, 0)  # Final parameter must be 0 (dp) or sends float and nothing works!
             return True
-        except:
+        except (OSError, ValueError, TypeError):  # No response, offline, or value out of range for the register.
             return False
 
+    def __set_holding_regs(self, start_register, values, device):
+        ''' Send message for setting consecutive holding registers, FC6 for one register, otherwise FC16. '''
+        try:
+            if len(values) == 1:
+                self.__transact(device, 'write_register', start_register, values[0], 0)
+            else:
+                self.__transact(device, 'write_registers', start_register, values)
+            return True
+        except (OSError, ValueError, TypeError):
+            return False
+
+
+class SerialBus:
+    ''' Owns the single open serial handle for one COM port.
+        Every slave address on the port is multiplexed through one Instrument whose address is
+        switched per transaction under the bus lock, so cars sharing an RS485 port never race. '''
+
+    def __init__(self, com_port, serial_config, serial_factory=None):
+        _import_serial()
+        self.com_port = com_port
+        self.lock = threading.RLock()  # Re-entrant so a caller may hold the bus over several transactions.
+        self.__serial_config = serial_config
+        self.__serial_factory = serial_factory
+        self.__instrument = None
+        self.__needs_reopen = False
+        self._open()
+
+    def _open(self):
+        ''' Create the Instrument and configure its serial port from the serial config dictionary. '''
+        if self.__serial_factory is not None:
+            port = self.__serial_factory(self.com_port)  # minimalmodbus accepts any serial-like object as the port.
+        else:
+            port = self.com_port
+        self.__instrument = minimalmodbus.Instrument(port, 1, minimalmodbus.MODE_RTU, close_port_after_each_call=False)
+        self.configure()
+        self.__needs_reopen = False
+
+    def configure(self):
+        ''' Apply the serial config dictionary to the port. '''
+        self.__instrument.serial.baudrate = self.__serial_config['baudrate']
+        self.__instrument.serial.bytesize = self.__serial_config['no_bits']
+        self.__instrument.serial.parity = self.__serial_config['parity']
+        self.__instrument.serial.stopbits = self.__serial_config['stop_bits']
+        self.__instrument.serial.timeout = self.__serial_config['timeout']
+
+    def reopen(self):
+        ''' Close and reopen the serial handle, e.g. after the adapter was unplugged and replugged. '''
+        with self.lock:
+            try:
+                self.__instrument.serial.close()
+            except (OSError, serial.SerialException):
+                pass
+            self.__instrument.serial.open()
+            self.__needs_reopen = False
+
+    def execute(self, slave_addr, method_name, *args, timeout=None):
+        ''' Run one Instrument method (e.g. 'read_register') against a slave address on this bus.
+            timeout (optional) overrides the serial config timeout for this transaction.
+            Modbus level errors (no/invalid response) leave the port open but flush stale input.
+            Serial level errors flag the handle to be reopened before the next transaction. '''
+        with self.lock:
+            if self.__needs_reopen:
+                self.reopen()
+            self.__instrument.address = slave_addr
+            self.__instrument.serial.timeout = self.__serial_config['timeout'] if timeout is None else timeout
+            try:
+                return getattr(self.__instrument, method_name)(*args)
+            except minimalmodbus.ModbusException:
+                self.__instrument.serial.reset_input_buffer()
+                raise
+            except (OSError, serial.SerialException):
+                self.__needs_reopen = True
+                raise
+
+    def close(self):
+        with self.lock:
+            self.__instrument.serial.close()
+
+
+class BusManager:
+    ''' Keeps one SerialBus per COM port so that all devices on a port share the same open handle. '''
+
+    def __init__(self, serial_config, serial_factory=None):
+        self.__serial_config = serial_config
+        self.__serial_factory = serial_factory
+        self.__bus_dict = dict()
+        self.__lock = threading.Lock()
+
+    def get_bus(self, com_port):
+        ''' Return the bus for the port, opening it on first use. '''
+        with self.__lock:
+            if com_port not in self.__bus_dict:
+                self.__bus_dict[com_port] = SerialBus(com_port, self.__serial_config, self.__serial_factory)
+            return self.__bus_dict[com_port]
+
+    def buses(self):
+        ''' Return a list of all currently open buses. '''
+        with self.__lock:
+            return list(self.__bus_dict.values())
+
+    def reconfigure(self):
+        ''' Apply a changed serial config to every open bus. '''
+        for bus in self.buses():
+            with bus.lock:
+                bus.configure()
+
+    def close_all(self):
+        with self.__lock:
+            for bus in self.__bus_dict.values():
+                bus.close()
+            self.__bus_dict = dict()
+
+
+
+class AsyncCommunication:
+    ''' asyncio front end to Communication with the same add_device/data_request/data_set surface as coroutines.
+        Register map and serial config loading is done by a wrapped Communication object (all keyword
+        arguments are passed straight through). Serial I/O is blocking, so each COM port gets its own
+        single worker thread: transactions on one bus stay in order while separate buses run
+        concurrently, making a full poll cycle as long as the slowest bus rather than the sum of all buses. '''
+
+    def __init__(self, **kwargs):
+        self.__comms = Communication(**kwargs)
+        self.__executor_dict = dict()  # COM port and its single thread executor.
+        self.__car_ports = dict()  # Car number and the COM port it is connected on.
+
+    @property
+    def communication(self):
+        ''' The wrapped synchronous Communication object. '''
+        return self.__comms
+
+    def __executor(self, com_port):
+        if com_port not in self.__executor_dict:
+            self.__executor_dict[com_port] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bus-' + str(com_port))
+        return self.__executor_dict[com_port]
+
+    async def __run_on_bus(self, com_port, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor(com_port), function, *args)
+
+    async def add_device(self, car_no, slave_addr, com_port):
+        ''' Add a device, opening its port on that port's own worker thread. '''
+        await self.__run_on_bus(com_port, self.__comms.add_device, car_no, slave_addr, com_port)
+        self.__car_ports[car_no] = com_port
+
+    async def data_request(self, car_no, register_name):
+        return await self.__run_on_bus(self.__car_ports[car_no], self.__comms.data_request, car_no, register_name)
+
+    async def data_request_many(self, car_no, register_names):
+        return await self.__run_on_bus(self.__car_ports[car_no], self.__comms.data_request_many, car_no, register_names)
+
+    async def read_group(self, car_no, group):
+        return await self.__run_on_bus(self.__car_ports[car_no], self.__comms.read_group, car_no, group)
+
+    async def data_set(self, car_no, register_name, setting_value):
+        return await self.__run_on_bus(self.__car_ports[car_no], self.__comms.data_set, car_no, register_name, setting_value)
+
+    async def data_set_many(self, car_no, settings):
+        return await self.__run_on_bus(self.__car_ports[car_no], self.__comms.data_set_many, car_no, settings)
+
+    async def poll_all(self, group, car_nos=None):
+        ''' Read a register group from every car (or the cars given) concurrently across all ports.
+            Returns a dictionary of car number and either its values dictionary or the exception raised. '''
+        if car_nos is None:
+            car_nos = list(self.__car_ports)
+        results = await asyncio.gather(*[self.read_group(car_no, group) for car_no in car_nos], return_exceptions=True)
+        return dict(zip(car_nos, results))
+
+    def close(self):
+        ''' Shut down the per-port worker threads. '''
+        for executor in self.__executor_dict.values():
+            executor.shutdown(wait=True)
+        self.__executor_dict = dict()
 
 
 ''' Class shall be instantiated through creation of object.
     Once created the object shall have only 1 public attribute, which is a list
     of all available COM ports. 
-    No public interface methods are required as initialisation runs method to find ports.'''
+    No public interface methods are required as initialisation runs method to find ports.
+    Results are cached at class level, so creating further objects (e.g. a hot-plug rescan)
+    only probes again when the set of candidate devices has changed or the cache has expired.'''
 
 class ComPorts:
     ''' Class serves to find all COM ports for any which are available.
     This is for the RS485 transceiver which is used for MODBUS communications.'''
 
-    def __init__(self):
-        """ Creates empty list for assigning ports.
-        raises EnvironmentError if not on Windows platform. """
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        else:
-            raise EnvironmentError('Unsupported platform')
-        self.__available_ports = self.find_ports(ports)  # Returns list of available COM ports.
-    
+    probe_deadline = 0.5  # Seconds allowed for all ports to be probed.
+    cache_ttl = 30.0  # Seconds before cached results are re-probed even if the device list is unchanged.
+    ping_timeout = 0.05  # Seconds to wait for each slave address to answer a Modbus ping.
+    __cache = dict()  # Candidate port tuple and (time probed, available ports).
+
+    def __init__(self, ping_addresses=None, serial_config=None):
+        """ Enumerates candidate ports and probes them in parallel, reusing cached results where valid.
+        ping_addresses (optional) is a list of slave addresses to Modbus ping on each available port,
+        the answering addresses for each port are then held in slaves. serial_config (optional) is the
+        serial config dictionary the slaves are set up for; without it minimalmodbus defaults (19200 8N1) are used. """
+        self.available_ports = self.find_ports(self.candidate_ports())  # List of available COM ports.
+        self.slaves = dict()
+        if ping_addresses is not None:
+            self.slaves = self.ping_ports(self.available_ports, ping_addresses, serial_config)
+
+    @staticmethod
+    def candidate_ports():
+        ''' Lists serial devices present on the system without opening them. Uses the pySerial port
+            listing (registry on Windows, sysfs on Linux) plus the usual USB/RS485 adapter device names. '''
+        _import_serial()
+        from serial.tools import list_ports
+        ports = [port.device for port in list_ports.comports()]
+        if sys.platform.startswith('linux'):
+            for pattern in ('/dev/ttyUSB*', '/dev/ttyACM*', '/dev/serial/by-id/*'):
+                ports.extend(os.path.realpath(port) for port in glob.glob(pattern))
+        elif sys.platform.startswith('darwin'):
+            ports.extend(glob.glob('/dev/cu.usbserial*') + glob.glob('/dev/cu.usbmodem*'))
+        return sorted(set(ports))
+
+    @classmethod
+    def invalidate(cls):
+        ''' Clear cached results so the next object probes every port again. '''
+        cls.__cache.clear()
+
     def find_ports(self, ports):
-        ''' Tries to open all COM ports and create Serial object.
-            If not possible the exception is caught, otherwise, the 
-            port is added to a list, which is returned. '''
+        ''' Tries to open all COM ports and create Serial object, all ports at once on a thread pool.
+            Ports which fail to open, or do not open within the probe deadline, are left out;
+            the remaining ports are returned as a list. '''
+        _import_serial()
+        key = tuple(ports)
+        cached = ComPorts.__cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < ComPorts.cache_ttl:
+            return list(cached[1])
         result = []
-        for port in ports:
-            try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
-                pass
+        if ports:
+            executor = ThreadPoolExecutor(max_workers=min(32, len(ports)))
+            futures = {executor.submit(self.__probe, port): port for port in ports}
+            done, not_done = wait(futures, timeout=ComPorts.probe_deadline)
+            executor.shutdown(wait=False)  # Ports still probing past the deadline are treated as unavailable.
+            result = [futures[future] for future in done if future.result()]
+            result.sort(key=ports.index)
+        ComPorts.__cache.clear()  # Only the latest device list is worth keeping.
+        ComPorts.__cache[key] = (time.monotonic(), result)
         return result
 
+    @staticmethod
+    def __probe(port):
+        try:
+            s = serial.Serial(port)
+            s.close()
+            return True
+        except (OSError, serial.SerialException):
+            return False
+
+    def ping_ports(self, ports, slave_addresses, serial_config=None):
+        ''' Modbus ping each slave address on every port, ports in parallel, see ping_slaves.
+            Returns a dictionary of port and the list of slave addresses which answered. '''
+        if not ports:
+            return dict()
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            futures = {port: executor.submit(self.ping_slaves, port, slave_addresses, serial_config=serial_config) for port in ports}
+            return {port: future.result() for port, future in futures.items()}
+
+    @staticmethod
+    def ping_slaves(port, slave_addresses, register=0, serial_config=None):
+        ''' Read one register from each slave address on the port. Any answer, including a Modbus
+            exception response, shows an Industruino is present at that address.
+            serial_config (optional) sets baudrate, bytesize, parity and stop bits as SerialBus.configure does,
+            the timeout is always ping_timeout. '''
+        _import_serial()
+        answered = []
+        try:
+            instrument = minimalmodbus.Instrument(port, 1, minimalmodbus.MODE_RTU, close_port_after_each_call=False)
+        except (OSError, serial.SerialException):
+            return answered
+        try:
+            if serial_config is not None:
+                instrument.serial.baudrate = serial_config['baudrate']
+                instrument.serial.bytesize = serial_config['no_bits']
+                instrument.serial.parity = serial_config['parity']
+                instrument.serial.stopbits = serial_config['stop_bits']
+            instrument.serial.timeout = ComPorts.ping_timeout
+            for slave_addr in slave_addresses:
+                instrument.address = slave_addr
+                try:
+                    instrument.read_register(register, 0)
+                    answered.append(slave_addr)
+                except minimalmodbus.SlaveReportedException:
+                    answered.append(slave_addr)
+                except (OSError, serial.SerialException):
+                    pass
+        finally:
+            instrument.serial.close()
+        return answered
+
 #cheeky = Communication()  # Pass the device upon which the communication shall be with.
 #cheeky.add_device(1,2,'COM5')
 #cheeky.data_set(1,'BC_SVAL',65534)  # 2583 equates to 10.23bar for testing.
@@ -0,0 +1,74 @@
+import hashlib
+import marshal  # Parser byte code, part of each entry's key.
+import os
+import pickle  # Compiled configs are stored as pickles, only ever read back from this program's own cache folder.
+import threading
+from pathlib import Path
+
+''' Cache of parsed and validated config files (register map, serial config, master config).
+    Each file's compiled form is kept in memory and in a pickle in __pycache__, keyed by the file's
+    path, modification time and size, with a SHA-1 of its contents as a fallback, and by the parser
+    (its name and a hash of its code, so editing a parser recompiles its files). An unchanged file is
+    therefore never parsed twice, and a file that was only touched (saved again with the same contents)
+    is recognised from its hash. Reloading configs from the Settings window only re-parses what changed. '''
+
+default_cache_file = Path(__file__).parent.absolute() / '__pycache__' / 'config_cache.pickle'
+
+_lock = threading.Lock()
+_cache_dict = None  # Path and (parser key, mtime_ns, size, sha1, compiled value), loaded on first use.
+
+
+def _load_cache_file():
+    global _cache_dict
+    if _cache_dict is None:
+        _cache_dict = dict()
+        try:
+            with open(default_cache_file, 'rb') as file:
+                _cache_dict = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass  # Missing or stale cache, everything is parsed again.
+
+
+def _save_cache_file():
+    try:
+        default_cache_file.parent.mkdir(exist_ok=True)
+        temporary_file = str(default_cache_file) + '.tmp'
+        with open(temporary_file, 'wb') as file:
+            pickle.dump(_cache_dict, file)
+        os.replace(temporary_file, default_cache_file)
+    except OSError:
+        pass  # A read-only install still works, it just parses on every start.
+
+
+def load(config_file, parser):
+    ''' Return parser(config_file), reusing the compiled result while the file is unchanged.
+        parser must be a module level function taking the file path and returning a picklable value.
+        Anything the result depends on other than the file and the parser's own code (e.g. a lookup table
+        it reads) must be applied by the caller after loading, or the cache will not see it change. '''
+    key = os.path.abspath(config_file)
+    parser_name = '%s.%s:%s' % (parser.__module__, parser.__qualname__,
+                                hashlib.sha1(marshal.dumps(parser.__code__)).hexdigest())
+    stat = os.stat(key)
+    with _lock:
+        _load_cache_file()
+        entry = _cache_dict.get(key)
+        if entry is not None and entry[0] == parser_name and entry[1:3] == (stat.st_mtime_ns, stat.st_size):
+            return entry[4]
+    with open(key, 'rb') as file:
+        digest = hashlib.sha1(file.read()).hexdigest()
+    with _lock:
+        if entry is not None and entry[0] == parser_name and entry[3] == digest:
+            value = entry[4]
+        else:
+            value = parser(config_file)
+        _cache_dict[key] = (parser_name, stat.st_mtime_ns, stat.st_size, digest, value)
+        _save_cache_file()
+    return value
+
+
+def clear():
+    ''' Forget every compiled config, in memory and on disk. '''
+    global _cache_dict
+    with _lock:
+        _cache_dict = dict()
+        _save_cache_file()
@@ -0,0 +1,131 @@
+import threading
+import numpy as np
+
+default_window = 600  # Samples in the sliding fit window, one minute at 10 Hz.
+default_test_duration = 600.0  # Seconds, length of a standard air leakage test.
+
+
+class DecayEstimator:
+    ''' Streaming decay rate and predicted end pressure for many pressure series at once.
+        Each series (keyed by (car_no, register_name)) holds running sums for a least-squares fit of
+        pressure and of ln(pressure) against time over a sliding window of samples. A new sample adds
+        its terms and removes those of the sample leaving the window, so an update is O(1) whatever the
+        window length, and results for every series are computed together as array operations.
+
+        Time is measured from each series' first sample (the start of the test) to keep the sums well
+        conditioned over long tests. '''
+
+    # Index of each running sum in the sums array.
+    N, ST, STT, SP, STP, SL, STL, SLL = range(8)
+
+    def __init__(self, window=default_window, test_duration=default_test_duration, max_series=64):
+        self.window = int(window)
+        self.test_duration = float(test_duration)
+        self.__slot_dict = dict()  # (car_no, register_name) and its row in the arrays below.
+        self.__lock = threading.Lock()
+        self.__allocate(max_series)
+        self.__results = None  # Cached output of results(), cleared on every update.
+
+    def __allocate(self, rows):
+        self.__sums = np.zeros((rows, 8))
+        self.__origin = np.full(rows, np.nan)  # Timestamp of first sample, i.e. test start.
+        self.__window_t = np.zeros((rows, self.window))
+        self.__window_p = np.ones((rows, self.window))
+        self.__head = np.zeros(rows, dtype=np.int64)
+
+    def __grow(self):
+        rows = len(self.__sums)
+        sums, origin, window_t, window_p, head = self.__sums, self.__origin, self.__window_t, self.__window_p, self.__head
+        self.__allocate(rows * 2)
+        self.__sums[:rows] = sums
+        self.__origin[:rows] = origin
+        self.__window_t[:rows] = window_t
+        self.__window_p[:rows] = window_p
+        self.__head[:rows] = head
+
+    def __slots(self, keys):
+        slots = []
+        for key in keys:
+            if key not in self.__slot_dict:
+                if len(self.__slot_dict) == len(self.__sums):
+                    self.__grow()
+                self.__slot_dict[key] = len(self.__slot_dict)
+            slots.append(self.__slot_dict[key])
+        return np.array(slots, dtype=np.int64)
+
+    def update_many(self, keys, timestamps, pressures):
+        ''' Add one sample to each of the series given. keys must be unique within a call.
+            Pressures at or below zero are ignored as they have no logarithm. '''
+        pressures = np.asarray(pressures, dtype=np.float64)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), pressures.shape)
+        valid = pressures > 0
+        if not valid.all():
+            keys = [key for key, ok in zip(keys, valid) if ok]
+            timestamps, pressures = timestamps[valid], pressures[valid]
+        with self.__lock:
+            slots = self.__slots(keys)
+            new_series = np.isnan(self.__origin[slots])
+            self.__origin[slots[new_series]] = timestamps[new_series]
+            t = timestamps - self.__origin[slots]
+            head = self.__head[slots]
+            full = self.__sums[slots, self.N] >= self.window
+            old_t = np.where(full, self.__window_t[slots, head], 0.0)
+            old_p = np.where(full, self.__window_p[slots, head], 1.0)
+            self.__sums[slots] += self.__terms(t, pressures) - full[:, None] * self.__terms(old_t, old_p)
+            self.__window_t[slots, head] = t
+            self.__window_p[slots, head] = pressures
+            self.__head[slots] = (head + 1) % self.window
+            self.__results = None
+
+    def update(self, key, timestamp, pressure):
+        self.update_many([key], timestamp, [pressure])
+
+    def add_sample(self, car_no, group, values, timestamp):
+        ''' Feed a polled sample, matching the Function sample callback signature. '''
+        self.update_many([(car_no, name) for name in values], timestamp, list(values.values()))
+
+    @staticmethod
+    def __terms(t, p):
+        l = np.log(p)
+        return np.stack([np.ones_like(t), t, t * t, p, t * p, l, t * l, l * l], axis=-1)
+
+    def results(self):
+        ''' Return a dictionary of (car_no, register_name) and a tuple of:
+            - rate: pressure drop per minute from the linear fit (positive when decaying)
+            - end_pressure: pressure predicted at test_duration from the exponential fit
+            - confidence: R squared (0 to 1) of the exponential fit over the window.
+            Values are nan until a series has at least three samples spanning some time.
+            Results are cached until the next update so this is cheap to poll from the Viewer. '''
+        with self.__lock:
+            if self.__results is None:
+                self.__results = self.__compute()
+            return self.__results
+
+    def __compute(self):
+        rows = len(self.__slot_dict)
+        n, st, stt, sp, stp, sl, stl, sll = self.__sums[:rows].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_t = n * stt - st * st
+            ok = (n >= 3) & (var_t > 1e-12 * n * n)
+            linear_slope = (n * stp - st * sp) / var_t
+            log_slope = (n * stl - st * sl) / var_t
+            log_intercept = (sl - log_slope * st) / n
+            end_pressure = np.exp(log_intercept + log_slope * self.test_duration)
+            var_l = n * sll - sl * sl
+            confidence = np.where(var_l > 1e-12 * n * n, (n * stl - st * sl) ** 2 / (var_t * var_l), 1.0)  # A flat series fits perfectly.
+        rate = np.where(ok, -linear_slope * 60.0, np.nan)
+        end_pressure = np.where(ok, end_pressure, np.nan)
+        confidence = np.where(ok, np.clip(confidence, 0.0, 1.0), np.nan)
+        rate, end_pressure, confidence = rate.tolist(), end_pressure.tolist(), confidence.tolist()
+        return {key: (rate[slot], end_pressure[slot], confidence[slot]) for key, slot in self.__slot_dict.items()}
+
+    def result(self, car_no, register_name):
+        ''' Return (rate, end_pressure, confidence) for one series, see results(). '''
+        return self.results().get((car_no, register_name), (np.nan, np.nan, np.nan))
+
+    def reset(self):
+        ''' Clear all series, e.g. at the start of a new test. '''
+        with self.__lock:
+            self.__slot_dict = dict()
+            self.__allocate(len(self.__sums))
+            self.__results = None
@@ -1,6 +1,34 @@
 import csv  # For reading the master_config.csv file
 from pathlib import Path
-from comms import Communication  # Review how this module is dealt with (inheritance or importing etc.)
+import config_cache
+
+default_register_map_file = r"C:\Users\Josh\Desktop\Work\BTS\registermap.csv"
+default_serial_configuration = r"C:\Users\Josh\Desktop\Work\BTS\serialconfig.csv"
+
+
+def _parse_master_config(master_config_file):
+    ''' Parse the master_config.csv into a dict of config type and (bool state, path). '''
+    master_config_dict = dict()  # Holds Bool state of library along with file path (if bool=1)
+    with open(master_config_file, encoding="utf-8-sig") as file:
+        csv_open = csv.DictReader(file)
+        for row in csv_open:
+            master_config_dict[row['type_of_config']] = (row['bool_state'], row['path'])
+    return master_config_dict
+
+
+def _parse_serial_config(serial_config_file):
+    ''' Parse and validate the serial configuration .csv into the serial config dictionary. '''
+    serial_config_dict = dict()
+    with open(serial_config_file, encoding="utf-8-sig") as file:
+        rows = csv.DictReader(file)
+        for row in rows:
+            serial_config_dict['baudrate'] = int(row['baudrate'])
+            serial_config_dict['no_bits'] = int(row['no_bits'])
+            serial_config_dict['parity'] = row['parity']
+            serial_config_dict['stop_bits'] = int(row['stop_bits'])
+            serial_config_dict['timeout'] = float(row['timeout'])
+    return serial_config_dict
+
 
 class Default:
 
@@ -8,24 +36,44 @@ class Default:
         ''' Open the master_config.csv and sees if super user has altered for new paths.
             This means that a password protected method can be used for future config file without changing
             any other class methods.
-            Communication object is instantiated from here. '''
+            Communication object is instantiated from here on first use of self.a, so start up does not
+            wait for the comms module, its serial imports or config parsing. '''
         path = Path(__file__).parent.absolute()  # Finds current modules path.
-        master_config_file = str(path) + '\master_config.csv'  # Append master_config file
-        self.__master_config_dict = dict()  # Holds Bool state of library along with file path (if bool=1)
-        with open(master_config_file, encoding="utf-8-sig") as file:
-            csv_open = csv.DictReader(file)
-            for row in csv_open:
-                self.__master_config_dict[row['type_of_config']] = (row['bool_state'], row['path'])
-        # If statements which send file path if bool is set to 1, otherwise leave empty.
-        self.instantiate_comms()
+        self.master_config_file = str(path / 'master_config.csv')  # Append master_config file
+        self.__master_config_dict = config_cache.load(self.master_config_file, _parse_master_config)
+        self.__comms = None
+
+    @property
+    def a(self):
+        ''' The Communication object, created the first time it is needed. '''
+        if self.__comms is None:
+            self.instantiate_comms()
+        return self.__comms
+
+    def __config_paths(self):
+        # Send file path if bool is set to 1, otherwise leave out so Communication uses its default.
+        paths = dict()
+        for type_of_config in ('register_map', 'serial_config'):
+            if int(self.__master_config_dict[type_of_config][0]) == 1:
+                paths[type_of_config] = self.__master_config_dict[type_of_config][1]
+        return paths
+
+    def serial_config(self):
+        ''' Return the parsed serial config dictionary (baudrate, no_bits, parity, stop_bits, timeout) without
+            creating the Communication object, e.g. for the Settings window. Raises OSError if the file is missing. '''
+        path = self.__config_paths().get('serial_config', default_serial_configuration)
+        return config_cache.load(path, _parse_serial_config)
 
     def instantiate_comms(self):
-        if int(self.__master_config_dict['register_map'][0]) == 1 and int(self.__master_config_dict['serial_config'][0]) == 1:
-            self.a = Communication(register_map = self.__master_config_dict['register_map'][1], 
-                          serial_config = self.__master_config_dict['serial_config'][1])
-        elif int(self.__master_config_dict['register_map'][0]) == 1:
-            self.a = Communication(register_map = self.__master_config_dict['register_map'][1])
-        elif int(self.__master_config_dict['serial_config'][0]) == 1:
-            self.a = Communication(serial_config = self.__master_config_dict['serial_config'][1])
-        else:
-            self.a = Communication()  # Pass no arguments
\ No newline at end of file
+        from comms import Communication  # Imported here, comms pulls in numpy, pySerial and minimalmodbus.
+        self.__comms = Communication(**self.__config_paths())
+
+    def reload_configs(self):
+        ''' Re-read the master config and, if Communication exists, its config files.
+            Unchanged files are not parsed again (see config_cache). '''
+        self.__master_config_dict = config_cache.load(self.master_config_file, _parse_master_config)
+        if self.__comms is not None:
+            paths = self.__config_paths()
+            paths.setdefault('register_map', default_register_map_file)
+            paths.setdefault('serial_config', default_serial_configuration)
+            self.__comms.reload_configs(**paths)
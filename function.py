@@ -1,3 +1,14 @@
+import heapq  # Deadline ordered queue of poll tasks for each bus.
+import threading
+import time
+from store import SampleStore
+from decay import DecayEstimator
+from alarms import AlarmEngine
+from recorder import Recorder, RecordingReader
+from comms import DeviceOfflineError
+import calibration
+
+
 class Function:
     ''' Implements functionality for:
         - Carrying out cyclic transducer/device polling
@@ -7,14 +18,248 @@ class Function:
         - Setting of alarms for exceedance
         - Storing of device calibration data (Sent by device prior to testing). '''
 
-    def __cyclic_polling(self):
-        pass
+    default_poll_rates = {'rval' : 10.0,  # Hz, live pressure readings.
+                          'sval' : 1.0}  # Hz, setpoints change rarely.
+
+    def __init__(self, communication, **kwargs):
+        ''' Takes the Communication object used for all device I/O.
+            poll_rates (optional) is a dictionary of register group and rate in Hz which
+            overrides the class default rates.
+            store_capacity and store_memory_cap (optional) size the live sample store.
+            alarm_rules (optional) is the path of an alarm rules .csv, checked for operation_mode (optional).
+            calibration_cache (optional) is the path of the calibration cache file. '''
+        self.__comms = communication
+        self.__poll_rates = dict(Function.default_poll_rates)
+        if 'poll_rates' in kwargs:
+            self.__poll_rates.update(kwargs['poll_rates'])
+        self.__sample_callbacks = []  # Called with (car_no, group, values, timestamp) for every poll.
+        self.__poll_threads = []
+        self.__stop_polling = threading.Event()
+        self.__stats_lock = threading.Lock()
+        self.__poll_stats = dict()  # Keyed by (car_no, group), see polling_statistics.
+        store_kwargs = dict()
+        if 'store_capacity' in kwargs:
+            store_kwargs['capacity'] = kwargs['store_capacity']
+        if 'store_memory_cap' in kwargs:
+            store_kwargs['memory_cap'] = kwargs['store_memory_cap']
+        self.store = SampleStore(**store_kwargs)
+        self.add_sample_callback(self.store.append_sample)  # Every polled value is saved for the viewer.
+        self.decay = None  # DecayEstimator, created by start_decay_calculation for operation mode 1.
+        self.alarms = None  # AlarmEngine, the Viewer drains self.alarms.events.
+        self.recorder = None  # Recorder, created by start_recording.
+        self.__calibration_cache_file = kwargs.get('calibration_cache', calibration.default_calibration_cache_file)
+        self.__calibration_cache = None  # CalibrationCache, opened on first load_calibration.
+        if 'alarm_rules' in kwargs:
+            self.alarms = AlarmEngine(kwargs['alarm_rules'], kwargs.get('operation_mode', 0))
+            self.add_sample_callback(self.alarms.check)
+
+    def set_poll_rate(self, group, rate_hz):
+        ''' Change the rate a register group is polled at. Takes effect on the next start_polling. '''
+        self.__poll_rates[group] = float(rate_hz)
+
+    def add_sample_callback(self, callback):
+        ''' Register a callable to receive every polled sample as (car_no, group, values, timestamp),
+            where values is a dictionary of register name and parsed value. '''
+        self.__sample_callbacks.append(callback)
+
+    def start_polling(self, car_nos):
+        ''' Start cyclic polling of every register group with a rate for each of the cars given.
+            One worker thread is started per COM port so that independent buses are polled in
+            parallel and none of the polling is carried out on the Tk thread. '''
+        self.stop_polling()
+        self.__stop_polling.clear()
+        cars_by_port = dict()
+        for car_no in car_nos:
+            cars_by_port.setdefault(self.__comms.device_port(car_no), []).append(car_no)
+        with self.__stats_lock:
+            self.__poll_stats = dict()
+        register_groups = self.__comms.register_groups()
+        self.store.reserve((car_no, register_name) for car_no in car_nos for group, rate_hz in self.__poll_rates.items()
+                           if rate_hz > 0 for register_name in register_groups.get(group, ()))  # Sized before any sample arrives.
+        for com_port, port_cars in cars_by_port.items():
+            thread = threading.Thread(target=self.__cyclic_polling, args=(port_cars,),
+                                      name='poll-' + str(com_port), daemon=True)
+            self.__poll_threads.append(thread)
+            thread.start()
+
+    def stop_polling(self):
+        ''' Signal all polling threads to stop and wait for them to finish. '''
+        self.__stop_polling.set()
+        for thread in self.__poll_threads:
+            thread.join()
+        self.__poll_threads = []
+
+    def polling_statistics(self):
+        ''' Return a copy of the polling statistics, keyed by (car_no, group). Each value is a dictionary of:
+            polls, missed (deadlines skipped because the bus was late), errors, offline (skipped by the circuit breaker),
+            last_error (the latest read error as text), callback_errors and last_callback_error (sample
+            callbacks that raised, the latest as text),
+            mean_jitter and max_jitter (seconds between deadline and start of the read). '''
+        with self.__stats_lock:
+            return {key: dict(stats) for key, stats in self.__poll_stats.items()}
+
+    def __cyclic_polling(self, car_nos):
+        ''' Worker for a single bus. Every (car, group) task sits on a heap ordered by its next deadline,
+            with shorter periods first on a tie, so fast registers are always served first while
+            slower groups still run as soon as their own deadline is the earliest.
+            A read finishing after the following deadline counts as missed and the task is moved on to its
+            next future slot rather than queued up, so a busy bus sheds load instead of building a backlog.
+            A read error never stops the thread; a task whose group has gone from the register map
+            (e.g. after reload_configs) is dropped. '''
+        now = time.perf_counter()
+        heap = []
+        register_groups = self.__comms.register_groups()
+        for car_no in car_nos:
+            for group, rate_hz in self.__poll_rates.items():
+                if rate_hz <= 0 or group not in register_groups:
+                    continue
+                period = 1.0 / rate_hz
+                heap.append((now, period, car_no, group))
+                with self.__stats_lock:
+                    self.__poll_stats[(car_no, group)] = {'polls' : 0, 'missed' : 0, 'errors' : 0, 'offline' : 0,
+                                                          'last_error' : None, 'callback_errors' : 0, 'last_callback_error' : None,
+                                                          'mean_jitter' : 0.0, 'max_jitter' : 0.0}
+        heapq.heapify(heap)
+        while heap and not self.__stop_polling.is_set():
+            deadline, period, car_no, group = heap[0]
+            wait = deadline - time.perf_counter()
+            if wait > 0:
+                if self.__stop_polling.wait(wait):
+                    break
+            start = time.perf_counter()
+            error = None
+            offline = False
+            try:
+                values = self.__comms.read_group(car_no, group)
+            except DeviceOfflineError:  # Circuit breaker open, no bus time was used.
+                offline = True
+            except Exception as read_error:  # Serial and Modbus errors, or anything else, must not end the thread.
+                if group not in self.__comms.register_groups():
+                    heapq.heappop(heap)  # Group removed by a register map reload, stop polling it.
+                    continue
+                error = read_error
+            timestamp = time.time()
+            callback_errors = []
+            if error is None and not offline:
+                callback_errors = self.__dispatch_polled_sample(car_no, group, values, timestamp)
+            finish = time.perf_counter()
+            if self.__comms.metrics is not None:
+                self.__comms.metrics.observe('poll_seconds', finish - start, group=group)
+                self.__comms.metrics.observe('poll_jitter_seconds', max(start - deadline, 0.0), group=group)
+            next_deadline = deadline + period
+            missed = 0
+            if finish > next_deadline:
+                missed = int((finish - next_deadline) // period) + 1
+                next_deadline += missed * period
+                if self.__comms.metrics is not None:
+                    self.__comms.metrics.increment('poll_missed_deadlines_total', missed, group=group)
+            if error is not None and self.__comms.metrics is not None:
+                self.__comms.metrics.increment('poll_errors_total', group=group)
+            if callback_errors and self.__comms.metrics is not None:
+                self.__comms.metrics.increment('poll_callback_errors_total', len(callback_errors), group=group)
+            heapq.heapreplace(heap, (next_deadline, period, car_no, group))
+            jitter = start - deadline
+            with self.__stats_lock:
+                stats = self.__poll_stats[(car_no, group)]
+                stats['polls'] += 1
+                stats['missed'] += missed
+                if error is not None:
+                    stats['errors'] += 1
+                    stats['last_error'] = repr(error)
+                stats['offline'] += int(offline)
+                if callback_errors:
+                    stats['callback_errors'] += len(callback_errors)
+                    stats['last_callback_error'] = repr(callback_errors[-1])
+                stats['mean_jitter'] += (jitter - stats['mean_jitter']) / stats['polls']
+                stats['max_jitter'] = max(stats['max_jitter'], jitter)
+
+    def __dispatch_sample(self, car_no, group, values, timestamp):
+        for callback in self.__sample_callbacks:
+            callback(car_no, group, values, timestamp)
+
+    def __dispatch_polled_sample(self, car_no, group, values, timestamp):
+        ''' As __dispatch_sample, but a callback that raises is skipped rather than stopping the bus's
+            polling thread; the rest still receive the sample. Returns a list of the exceptions raised. '''
+        callback_errors = []
+        for callback in self.__sample_callbacks:
+            try:
+                callback(car_no, group, values, timestamp)
+            except Exception as callback_error:
+                callback_errors.append(callback_error)
+        return callback_errors
+
+    def start_recording(self, recording_file, unit_no, project, operation_mode):
+        ''' Record every polled sample to a binary test recording (see recorder.py).
+            An existing recording file is appended to if it is for the same unit, project, operation mode
+            and register groups, otherwise ValueError is raised. '''
+        header = {'unit_no' : unit_no, 'project' : project, 'operation_mode' : operation_mode,
+                  'register_groups' : self.__comms.register_groups()}
+        self.recorder = Recorder(recording_file, header)
+        self.add_sample_callback(self.recorder.append_sample)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.__sample_callbacks.remove(self.recorder.append_sample)
+            self.recorder.close()
+            self.recorder = None
+
+    def replay_recording(self, recording_file, speed=None):
+        ''' Feed a recording back through the same sample callbacks as live polling.
+            speed (optional) replays in real time scaled by speed, otherwise as fast as possible. '''
+        reader = RecordingReader(recording_file)
+        try:
+            reader.replay(self.__dispatch_sample, speed)
+        finally:
+            reader.close()
+        return reader.header
+
+    def start_decay_calculation(self, test_duration, **kwargs):
+        ''' Start live decay rate and predicted end pressure calculation for every car being polled
+            (operation mode 1, Single Vehicle Air Leakage). test_duration is in seconds from the first sample.
+            window (optional) is the number of samples in the sliding fit. Results are read through self.decay. '''
+        decay_kwargs = {'test_duration' : test_duration}
+        if 'window' in kwargs:
+            decay_kwargs['window'] = kwargs['window']
+        if self.decay is None:
+            self.add_sample_callback(self._decay_rate_calculation)
+        self.decay = DecayEstimator(**decay_kwargs)
+
+    def _decay_rate_calculation(self, car_no, group, values, timestamp):
+        ''' Sample callback passing live pressure readings on to the decay estimator. '''
+        if group == 'rval' and self.decay is not None:
+            self.decay.add_sample(car_no, group, values, timestamp)
 
-    def _decay_rate_calculation(self):
-        pass
+    def load_calibration(self, car_nos):
+        ''' Apply each car's calibration before a test. The device id and calibration checksum are read first;
+            if the cache holds a table for that device with the same checksum it is reused, otherwise the
+            calibration table is downloaded with block reads and cached for later sessions.
+            Returns a dictionary of car number and True where the cached table was used, False where it was
+            downloaded, or None where the car could not be read (offline or no response); such a car is left
+            without calibration and the remaining cars are still loaded. '''
+        if self.__calibration_cache is None:
+            self.__calibration_cache = calibration.CalibrationCache(self.__calibration_cache_file)
+        cache_used = dict()
+        for car_no in car_nos:
+            try:
+                identity = self.__comms.data_request_many(car_no, [calibration.device_id_register, calibration.checksum_register])
+                device_id = int(identity[calibration.device_id_register])
+                checksum = int(identity[calibration.checksum_register])
+                table = self.__calibration_cache.get(device_id, checksum)
+                cache_used[car_no] = table is not None
+                if table is None:
+                    table = {name: int(value) for name, value in self.__comms.read_group(car_no, calibration.calibration_group).items()}
+            except OSError:  # Covers DeviceOfflineError, serial errors and all Modbus exceptions.
+                cache_used[car_no] = None
+                self.__comms.set_calibration(car_no, dict())  # Never keep a table that may belong to another device.
+                continue
+            if not cache_used[car_no]:
+                self._calibration_data_save(device_id, checksum, table)
+            self.__comms.set_calibration(car_no, self._calibration_data_parse(table))
+        return cache_used
 
-    def _calibration_data_parse(self):
-        pass
+    def _calibration_data_parse(self, table):
+        ''' Turn a raw calibration table into per-register (scale, offset), see calibration.py. '''
+        return calibration.parse_calibration_table(table)
 
-    def _calibration_data_save(self):
-        pass
\ No newline at end of file
+    def _calibration_data_save(self, device_id, checksum, table):
+        self.__calibration_cache.save(device_id, checksum, table)
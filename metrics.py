@@ -0,0 +1,165 @@
+import bisect
+import csv
+import os
+import threading
+import time
+
+''' Opt-in instrumentation for the Modbus layer. A Metrics object is passed to Communication (metrics=...)
+    and the polling loop picks it up from there; with no Metrics object the hot path only does an
+    "is not None" check. Counters and fixed-bucket histograms are keyed by name and a tuple of
+    (label, value) pairs, read through snapshot() and written out by MetricsExporter. '''
+
+# Histogram bucket upper bounds in seconds, from a fast in-process call up to a full Modbus timeout.
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    ''' Fixed-bucket histogram, observe() is a bisect and two increments. '''
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last count is above the highest bucket.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+class Metrics:
+    ''' Registry of counters and histograms. Labels are given as keyword arguments, e.g.
+        metrics.increment('modbus_errors_total', port='COM5', slave='2', kind='timeout'). '''
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.__counters = dict()  # (name, labels) and count.
+        self.__histograms = dict()  # (name, labels) and Histogram.
+        self.__lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        ''' Return (counters, histograms) copies: dictionaries keyed by (name, labels). '''
+        with self.__lock:
+            return dict(self.__counters), {key: histogram.copy() for key, histogram in self.__histograms.items()}
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = dict()
+            self.__histograms = dict()
+
+    def to_prometheus(self):
+        ''' Return all metrics in the Prometheus text exposition format. '''
+        counters, histograms = self.snapshot()
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            lines.append('# TYPE %s counter' % name)
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        for name in sorted({key[0] for key in histograms}):
+            lines.append('# TYPE %s histogram' % name)
+            for (histogram_name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', str(bound)),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def to_rows(self):
+        ''' Return a list of (name, labels, statistic, value) rows, histograms summarised as count, sum and mean. '''
+        counters, histograms = self.snapshot()
+        rows = [(name, _format_labels(labels), 'count', value) for (name, labels), value in sorted(counters.items())]
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            rows.append((name, _format_labels(labels), 'count', histogram.count))
+            rows.append((name, _format_labels(labels), 'sum', histogram.sum))
+            rows.append((name, _format_labels(labels), 'mean', histogram.sum / histogram.count if histogram.count else 0.0))
+        return rows
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (label, value) for label, value in labels) + '}'
+
+
+class MetricsExporter:
+    ''' Background thread writing the metrics every interval seconds, either as a Prometheus text file
+        (replaced atomically, for a node exporter textfile collector) or appended to a CSV which is
+        rotated to .1, .2 ... once it exceeds max_bytes. '''
+
+    def __init__(self, metrics, export_file, interval=10.0, export_format='prometheus', max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.metrics = metrics
+        self.export_file = export_file
+        self.interval = interval
+        self.export_format = export_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='metrics-export', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        ''' Stop the thread, writing the metrics one final time. '''
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.export()
+        self.export()
+
+    def export(self):
+        if self.export_format == 'prometheus':
+            temporary_file = self.export_file + '.tmp'
+            with open(temporary_file, 'w', encoding='utf-8') as file:
+                file.write(self.metrics.to_prometheus())
+            os.replace(temporary_file, self.export_file)
+        else:
+            self.__rotate()
+            new_file = not os.path.exists(self.export_file)
+            timestamp = time.time()
+            with open(self.export_file, 'a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                if new_file:
+                    writer.writerow(['timestamp', 'name', 'labels', 'statistic', 'value'])
+                for row in self.metrics.to_rows():
+                    writer.writerow((timestamp,) + row)
+
+    def __rotate(self):
+        if not os.path.exists(self.export_file) or os.path.getsize(self.export_file) < self.max_bytes:
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.export_file, index)):
+                os.replace('%s.%d' % (self.export_file, index), '%s.%d' % (self.export_file, index + 1))
+        os.replace(self.export_file, self.export_file + '.1')
@@ -0,0 +1,204 @@
+import json  # Recording header is stored as JSON.
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib  # CRC32 of each chunk.
+import numpy as np
+
+''' Test recording file layout (all little endian):
+    - file header: magic b'NAYREC01', uint32 header length, JSON header of that length
+    - any number of chunks: magic b'CHNK', uint32 record count, uint32 CRC32 of the records, records
+    Each record is sample_dtype. Chunks are only ever appended, so after a crash the file is valid
+    up to the last complete chunk and anything after it is discarded when the file is reopened. '''
+
+file_magic = b'NAYREC01'
+chunk_magic = b'CHNK'
+file_header_struct = struct.Struct('<8sI')
+chunk_header_struct = struct.Struct('<4sII')
+sample_dtype = np.dtype([('timestamp', '<f8'), ('car_no', '<u2'), ('register', '<u2'), ('value', '<f8')])
+default_chunk_size = 4096  # Records buffered before a chunk is written.
+default_flush_interval = 2.0  # Seconds, a chunk is also written once this long has passed since the last one.
+
+
+def _valid_chunks(buffer, offset, verify_all=False):
+    ''' Walk the chunks from offset and return a list of (record offset, record count) for every complete chunk.
+        Only the final chunk's CRC is checked unless verify_all, as a torn write can only affect the tail. '''
+    chunks = []
+    size = len(buffer)
+    while offset + chunk_header_struct.size <= size:
+        magic, count, crc = chunk_header_struct.unpack_from(buffer, offset)
+        start = offset + chunk_header_struct.size
+        end = start + count * sample_dtype.itemsize
+        if magic != chunk_magic or end > size:
+            break
+        chunks.append((start, count, crc))
+        offset = end
+    first = 0 if verify_all else max(len(chunks) - 1, 0)
+    for index in range(first, len(chunks)):
+        start, count, crc = chunks[index]
+        if zlib.crc32(buffer[start:start + count * sample_dtype.itemsize]) != crc:
+            chunks = chunks[:index]
+            break
+    return [(start, count) for start, count, crc in chunks]
+
+
+def _read_header(file):
+    magic, header_length = file_header_struct.unpack(file.read(file_header_struct.size))
+    if magic != file_magic:
+        raise ValueError('Not a test recording file')
+    header = json.loads(file.read(header_length).decode('utf-8'))
+    return header, file_header_struct.size + header_length
+
+
+def _check_header(recording_file, stored, header):
+    ''' Raise ValueError if any entry of header differs from the stored header of an existing recording. '''
+    header = json.loads(json.dumps(header))  # Compare as stored, e.g. tuples become lists.
+    different = sorted(key for key, value in header.items() if key != 'created' and stored.get(key) != value)
+    if different:
+        raise ValueError('%s is a recording with a different %s' % (recording_file, ', '.join(different)))
+
+
+class Recorder:
+    ''' Streams polled samples into an append-only binary recording.
+        header is a dictionary saved at the start of the file, e.g. unit_no, project, operation_mode;
+        register_groups (register group and list of names, as Communication.register_groups) is required and
+        is used to give each register a 16 bit index. Opening an existing file appends to it, first
+        discarding any partial chunk left by a crash. The existing header is kept; a header given must match
+        it (apart from 'created'), otherwise ValueError is raised rather than mixing two tests in one file.
+        A chunk is written when chunk_size records are buffered or flush_interval seconds have passed since
+        the last write, whichever is first, so a crash loses at most that much of the test. '''
+
+    def __init__(self, recording_file, header=None, chunk_size=default_chunk_size, fsync=False,
+                 flush_interval=default_flush_interval):
+        self.recording_file = recording_file
+        self.__chunk = np.zeros(chunk_size, dtype=sample_dtype)
+        self.__length = 0  # Records in the current chunk.
+        self.__fsync = fsync
+        self.__flush_interval = flush_interval
+        self.__last_write = time.monotonic()
+        self.__lock = threading.Lock()
+        if os.path.exists(recording_file) and os.path.getsize(recording_file) > 0:
+            with open(recording_file, 'rb') as file:
+                self.header, data_offset = _read_header(file)
+                if header is not None:
+                    _check_header(recording_file, self.header, header)
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                    chunks = _valid_chunks(contents, data_offset)
+            end = chunks[-1][0] + chunks[-1][1] * sample_dtype.itemsize if chunks else data_offset
+            self.__file = open(recording_file, 'r+b')
+            self.__file.truncate(end)
+            self.__file.seek(end)
+        else:
+            self.header = dict(header)
+            self.header.setdefault('created', time.time())
+            self.header['registers'] = [name for names in header['register_groups'].values() for name in names]
+            encoded = json.dumps(self.header).encode('utf-8')
+            self.__file = open(recording_file, 'wb')
+            self.__file.write(file_header_struct.pack(file_magic, len(encoded)) + encoded)
+            self.__file.flush()
+        self.__register_index = {name: index for index, name in enumerate(self.header['registers'])}
+
+    def append_sample(self, car_no, group, values, timestamp):
+        ''' Record a polled sample, matching the Function sample callback signature. '''
+        with self.__lock:
+            for register_name, value in values.items():
+                if self.__length == len(self.__chunk):
+                    self.__write_chunk()
+                record = self.__chunk[self.__length]
+                record['timestamp'] = timestamp
+                record['car_no'] = car_no
+                record['register'] = self.__register_index[register_name]
+                record['value'] = value
+                self.__length += 1
+            if time.monotonic() - self.__last_write >= self.__flush_interval:
+                self.__write_chunk()
+
+    def __write_chunk(self):
+        self.__last_write = time.monotonic()
+        if self.__length == 0:
+            return
+        payload = self.__chunk[:self.__length].tobytes()
+        self.__file.write(chunk_header_struct.pack(chunk_magic, self.__length, zlib.crc32(payload)) + payload)
+        self.__file.flush()
+        if self.__fsync:
+            os.fsync(self.__file.fileno())
+        self.__length = 0
+
+    def flush(self):
+        ''' Write out any buffered records as a chunk. '''
+        with self.__lock:
+            self.__write_chunk()
+
+    def close(self):
+        with self.__lock:
+            self.__write_chunk()
+            self.__file.close()
+
+
+class RecordingReader:
+    ''' Memory maps a recording for review. Opening only reads the header and walks the chunk headers,
+        records are returned as zero-copy structured array views onto the file. '''
+
+    def __init__(self, recording_file, verify=False):
+        self.__file = open(recording_file, 'rb')
+        self.header, data_offset = _read_header(self.__file)
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__chunks = _valid_chunks(self.__mmap, data_offset, verify)
+        self.registers = self.header['registers']
+        self.__group_of = {name: group for group, names in self.header['register_groups'].items() for name in names}
+
+    def __len__(self):
+        return sum(count for start, count in self.__chunks)
+
+    def chunks(self):
+        ''' Yield each chunk's records as a structured array view. '''
+        for start, count in self.__chunks:
+            yield np.frombuffer(self.__mmap, dtype=sample_dtype, count=count, offset=start)
+
+    def records(self):
+        ''' Return all records as one structured array (a copy when there is more than one chunk). '''
+        chunks = list(self.chunks())
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return np.zeros(0, dtype=sample_dtype)
+        return np.concatenate(chunks)
+
+    def series(self, car_no, register_name):
+        ''' Return (timestamps, values) arrays for one car and register. '''
+        register = self.registers.index(register_name)
+        parts = [chunk[(chunk['car_no'] == car_no) & (chunk['register'] == register)] for chunk in self.chunks()]
+        if not parts:
+            return np.zeros(0), np.zeros(0)
+        selected = np.concatenate(parts)
+        return selected['timestamp'], selected['value']
+
+    def replay(self, callback, speed=None):
+        ''' Feed the recording back as (car_no, group, values, timestamp) calls, the same as live polling,
+            so samples pass through the store, decay calculation and alarms unchanged.
+            speed (optional) replays in real time scaled by speed, otherwise as fast as possible. '''
+        start_wall = time.perf_counter()
+        start_timestamp = None
+        for chunk in self.chunks():
+            index = 0
+            while index < len(chunk):
+                timestamp, car_no = chunk['timestamp'][index], chunk['car_no'][index]
+                group = self.__group_of[self.registers[chunk['register'][index]]]
+                values = dict()
+                while (index < len(chunk) and chunk['timestamp'][index] == timestamp and chunk['car_no'][index] == car_no
+                       and self.__group_of[self.registers[chunk['register'][index]]] == group):
+                    values[self.registers[chunk['register'][index]]] = float(chunk['value'][index])
+                    index += 1
+                if speed:
+                    if start_timestamp is None:
+                        start_timestamp = timestamp
+                    delay = (timestamp - start_timestamp) / speed - (time.perf_counter() - start_wall)
+                    if delay > 0:
+                        time.sleep(delay)
+                callback(int(car_no), group, values, float(timestamp))
+
+    def close(self):
+        self.__mmap.close()
+        self.__file.close()
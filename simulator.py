@@ -0,0 +1,215 @@
+import csv  # For reading the register map .csv file.
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+''' Simulated Industruino Modbus RTU slaves, so comms.py can be exercised and benchmarked without hardware.
+    - SimulatedBus is a serial-port-like object for in-process use, passed to Communication as
+      serial_factory=lambda port: bus (or a dictionary lookup of one bus per port).
+    - PtySlaveServer serves the same slaves on a Linux pseudo terminal, so Communication opens the
+      returned port name exactly as it would a real adapter.
+    Holding register reads (FC3), single writes (FC6) and multiple writes (FC16) are supported,
+    including broadcast writes to address 0. '''
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_crc16_table = _crc_table()
+
+
+def crc16(data):
+    ''' Modbus RTU CRC-16, returned as the two bytes to append to a frame (low byte first). '''
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _crc16_table[(crc ^ byte) & 0xFF]
+    return struct.pack('<H', crc)
+
+
+def character_time(baudrate, bytesize=8, parity='N', stopbits=1):
+    ''' Seconds to send one character on the wire, including start, parity and stop bits. '''
+    bits = 1 + bytesize + (0 if parity == 'N' else 1) + stopbits
+    return bits / baudrate
+
+
+class SimulatedSlave:
+    ''' One Industruino's holding registers and behaviour.
+        turnaround is the slave processing time before replying. timeout_rate and crc_error_rate are the
+        probabilities of not answering a request and of answering with a corrupted CRC. '''
+
+    def __init__(self, slave_addr, registers=None, turnaround=0.002, timeout_rate=0.0, crc_error_rate=0.0, seed=None):
+        self.slave_addr = slave_addr
+        self.registers = dict(registers or {})  # Register number and 16 bit value.
+        self.turnaround = turnaround
+        self.timeout_rate = timeout_rate
+        self.crc_error_rate = crc_error_rate
+        self.requests = 0
+        self.__random = random.Random(seed)
+
+    @classmethod
+    def from_register_map(cls, slave_addr, register_map_file, initial_value=0x0A00, **kwargs):
+        ''' Create a slave with every register in the register map .csv set to initial_value (10.00 bar). '''
+        registers = dict()
+        with open(register_map_file, encoding="utf-8-sig") as file:
+            for row in csv.DictReader(file):
+                registers[int(row['regno'])] = initial_value
+        return cls(slave_addr, registers, **kwargs)
+
+    def handle(self, frame):
+        ''' Process a request frame. Returns the response frame, or None if the slave stays silent. '''
+        if len(frame) < 4 or crc16(frame[:-2]) != frame[-2:]:
+            return None  # Real slaves ignore frames with a bad CRC.
+        address, function_code = frame[0], frame[1]
+        broadcast = address == 0
+        if not broadcast and address != self.slave_addr:
+            return None
+        self.requests += 1
+        if self.__random.random() < self.timeout_rate:
+            return None
+        if function_code == 3:
+            start, count = struct.unpack('>HH', frame[2:6])
+            if not 1 <= count <= 125 or any(start + i not in self.registers for i in range(count)):
+                body = bytes([address, function_code | 0x80, 2])
+            else:
+                values = [self.registers[start + i] for i in range(count)]
+                body = bytes([address, function_code, 2 * count]) + struct.pack('>%dH' % count, *values)
+        elif function_code == 6:
+            register, value = struct.unpack('>HH', frame[2:6])
+            if register not in self.registers:
+                body = bytes([address, function_code | 0x80, 2])
+            else:
+                self.registers[register] = value
+                body = frame[:6]
+        elif function_code == 16:
+            start, count, byte_count = struct.unpack('>HHB', frame[2:7])
+            if any(start + i not in self.registers for i in range(count)):
+                body = bytes([address, function_code | 0x80, 2])
+            else:
+                values = struct.unpack('>%dH' % count, frame[7:7 + byte_count])
+                for i, value in enumerate(values):
+                    self.registers[start + i] = value
+                body = frame[:6]
+        else:
+            body = bytes([address, function_code | 0x80, 1])  # Illegal function.
+        if broadcast:
+            return None  # Broadcasts are carried out but never answered.
+        response = body + crc16(body)
+        if self.__random.random() < self.crc_error_rate:
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        return response
+
+
+class SimulatedBus:
+    ''' In-process serial-port-like object with any number of SimulatedSlaves attached.
+        Wire time is modelled from the baudrate and frame lengths, so timings and throughput
+        match a real RS485 bus; busy_time accumulates the time the bus carried data. '''
+
+    def __init__(self, slaves=(), port='SIM'):
+        self.port = port
+        self.baudrate = 19200
+        self.bytesize = 8
+        self.parity = 'N'
+        self.stopbits = 1
+        self.timeout = 0.05
+        self.write_timeout = 2.0
+        self.is_open = True
+        self.slaves = list(slaves)
+        self.busy_time = 0.0
+        self.__response = b''
+        self.__ready_at = 0.0  # perf_counter time at which the response has fully arrived.
+
+    def add_slave(self, slave):
+        self.slaves.append(slave)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        self.__response = b''
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def __wire_time(self, number_of_bytes):
+        return number_of_bytes * character_time(self.baudrate, self.bytesize, self.parity, self.stopbits)
+
+    def write(self, data):
+        data = bytes(data)
+        request_time = self.__wire_time(len(data))
+        time.sleep(request_time)
+        self.busy_time += request_time
+        self.__response = b''
+        self.__ready_at = time.perf_counter()
+        for slave in self.slaves:
+            response = slave.handle(data)
+            if response is not None:
+                response_time = self.__wire_time(len(response))
+                self.busy_time += response_time
+                self.__response = response
+                self.__ready_at += slave.turnaround + response_time
+        return len(data)
+
+    def read(self, size=1):
+        ''' Block until the response has arrived, or for the timeout if it is shorter than size. '''
+        response, self.__response = self.__response[:size], self.__response[size:]
+        wait = self.__ready_at - time.perf_counter()
+        if len(response) < size:
+            wait = max(wait, 0.0) + self.timeout
+        if wait > 0:
+            time.sleep(wait)
+        return response
+
+
+class PtySlaveServer:
+    ''' Serves SimulatedSlaves on a Linux pseudo terminal. port is the device name to hand to
+        Communication.add_device. Frames are delimited by the RTU 3.5 character silent interval. '''
+
+    def __init__(self, slaves=(), baudrate=19200):
+        import termios  # Only available on POSIX, imported here so the in-process simulator works anywhere.
+        import tty
+        self.slaves = list(slaves)
+        self.baudrate = baudrate
+        self.__master_fd, self.__slave_fd = os.openpty()
+        tty.setraw(self.__slave_fd, termios.TCSANOW)
+        self.port = os.ttyname(self.__slave_fd)
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__serve, name='pty-slave', daemon=True)
+        self.__thread.start()
+
+    def __serve(self):
+        silent_interval = max(3.5 * character_time(self.baudrate), 0.00175)
+        frame = b''
+        while not self.__stop.is_set():
+            readable, _, _ = select.select([self.__master_fd], [], [], silent_interval if frame else 0.1)
+            if readable:
+                frame += os.read(self.__master_fd, 256)
+                continue
+            if frame:
+                for slave in self.slaves:
+                    response = slave.handle(frame)
+                    if response is not None:
+                        time.sleep(slave.turnaround + len(response) * character_time(self.baudrate))
+                        os.write(self.__master_fd, response)
+                frame = b''
+
+    def close(self):
+        self.__stop.set()
+        self.__thread.join()
+        os.close(self.__master_fd)
+        os.close(self.__slave_fd)
@@ -0,0 +1,143 @@
+import threading
+import numpy as np  # Array backed buffers, no Python object per sample.
+
+default_capacity = 200000  # Most samples kept per (car, register), ~55 hours at 1 Hz or ~5.5 hours at 10 Hz.
+default_memory_cap = 256 * 1024 * 1024  # Bytes allowed for all buffers in one SampleStore.
+
+
+class RingBuffer:
+    ''' Fixed capacity time-series of timestamps and values held in preallocated float64 arrays.
+        Each sample is written twice, at i and i + capacity, so the most recent n samples are always
+        one contiguous slice and window() can hand out views without copying. '''
+
+    bytes_per_sample = 2 * 2 * 8  # Timestamp and value, float64, mirrored.
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.__timestamps = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.__values = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.__head = 0  # Index the next sample is written to (0 to capacity - 1).
+        self.count = 0  # Total samples appended, may exceed capacity.
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, value):
+        ''' Add one sample, overwriting the oldest once the buffer is full. '''
+        head = self.__head
+        self.__timestamps[head] = self.__timestamps[head + self.capacity] = timestamp
+        self.__values[head] = self.__values[head + self.capacity] = value
+        self.__head = (head + 1) % self.capacity
+        self.count += 1  # Updated last so readers never see a half written sample.
+
+    def window(self, n=None, since=None):
+        ''' Return (timestamps, values) views of the last n samples, or of all samples from the
+            timestamp since onwards. The views are only valid until the buffer wraps round to them,
+            so copy them if they are to be kept. '''
+        available = len(self)
+        end = self.__head + self.capacity
+        start = end - available
+        timestamps = self.__timestamps[start:end]
+        if since is not None:
+            start += int(np.searchsorted(timestamps, since, side='left'))
+        elif n is not None:
+            start = end - min(int(n), available)
+        return self.__timestamps[start:end], self.__values[start:end]
+
+    def latest(self):
+        ''' Return the most recent (timestamp, value), or None if empty. '''
+        if self.count == 0:
+            return None
+        index = (self.__head - 1) % self.capacity
+        return self.__timestamps[index], self.__values[index]
+
+    def resized(self, capacity):
+        ''' Return a new RingBuffer of the given capacity holding the most recent samples of this one. '''
+        buffer = RingBuffer(capacity)
+        timestamps, values = self.window(capacity)
+        n = len(timestamps)
+        buffer.__timestamps[:n] = buffer.__timestamps[capacity:capacity + n] = timestamps
+        buffer.__values[:n] = buffer.__values[capacity:capacity + n] = values
+        buffer.__head = n % capacity
+        buffer.count = self.count
+        return buffer
+
+
+class SampleStore:
+    ''' Live sample store of one RingBuffer per (car_no, register_name).
+        capacity is the most samples kept per series. memory_cap bounds the total memory used across all
+        of them, so each series holds the smaller of capacity and an equal share of memory_cap
+        (series_capacity). Call reserve with every series before polling starts so the buffers are sized
+        up front; a series first seen later still gets a buffer, the others are shrunk to make room. '''
+
+    def __init__(self, capacity=default_capacity, memory_cap=default_memory_cap):
+        self.capacity = int(capacity)
+        self.memory_cap = int(memory_cap)
+        self.series_capacity = self.capacity
+        self.__buffer_dict = dict()
+        self.__lock = threading.Lock()  # Only held when new series are created.
+
+    def memory_used(self):
+        return sum(buffer.capacity for buffer in list(self.__buffer_dict.values())) * RingBuffer.bytes_per_sample
+
+    def reserve(self, keys):
+        ''' Create buffers for the (car_no, register_name) series given, sizing every series for the
+            new total. Raises MemoryError if memory_cap cannot hold even one sample per series. '''
+        with self.__lock:
+            new_keys = [key for key in dict.fromkeys(keys) if key not in self.__buffer_dict]
+            if new_keys:
+                self.__add_series(new_keys)
+
+    def __add_series(self, new_keys):
+        series = len(self.__buffer_dict) + len(new_keys)
+        series_capacity = min(self.capacity, self.memory_cap // (series * RingBuffer.bytes_per_sample))
+        if series_capacity < 1:
+            raise MemoryError('Sample store memory cap of %d bytes cannot hold %d series' % (self.memory_cap, series))
+        buffer_dict = dict(self.__buffer_dict)
+        if series_capacity < self.series_capacity:
+            for key, buffer in buffer_dict.items():
+                if buffer.capacity > series_capacity:
+                    buffer_dict[key] = buffer.resized(series_capacity)
+        for key in new_keys:
+            buffer_dict[key] = RingBuffer(series_capacity)
+        self.series_capacity = series_capacity
+        self.__buffer_dict = buffer_dict  # Swapped in whole so readers never see a partly built dict.
+
+    def __buffer(self, key):
+        buffer = self.__buffer_dict.get(key)
+        if buffer is None:
+            with self.__lock:
+                if key not in self.__buffer_dict:
+                    self.__add_series([key])
+                buffer = self.__buffer_dict[key]
+        return buffer
+
+    def append(self, car_no, register_name, timestamp, value):
+        self.__buffer((car_no, register_name)).append(timestamp, value)
+
+    def append_sample(self, car_no, group, values, timestamp):
+        ''' Add a polled sample, matching the Function sample callback signature. '''
+        for register_name, value in values.items():
+            self.__buffer((car_no, register_name)).append(timestamp, value)
+
+    def window(self, car_no, register_name, n=None, since=None):
+        ''' Return zero-copy (timestamps, values) views for a series, see RingBuffer.window.
+            Empty arrays are returned for a series with no samples yet. '''
+        buffer = self.__buffer_dict.get((car_no, register_name))
+        if buffer is None:
+            return np.empty(0), np.empty(0)
+        return buffer.window(n, since)
+
+    def latest(self, car_no, register_name):
+        buffer = self.__buffer_dict.get((car_no, register_name))
+        if buffer is None:
+            return None
+        return buffer.latest()
+
+    def keys(self):
+        return list(self.__buffer_dict)
+
+    def clear(self):
+        with self.__lock:
+            self.__buffer_dict = dict()
+            self.series_capacity = self.capacity
@@ -3,6 +3,7 @@ import tkinter as tk  # renaming tkinter to tk for ease and efficiency
 from tkinter import *  # this is importing all (*) modules from the tkinter package
 from datetime import *
 import time  # for the timing to refresh the live values
+import queue  # Hand over of live samples from the polling threads to the Tk thread
 from tkinter import filedialog as fd
 import default
 
@@ -56,6 +57,81 @@ class Settings:
             python program root folder will be utilised. '''
         pass
 
+class LiveValues:
+    ''' Live values pane, one row per car and one column per register.
+        add_sample is called from the polling threads and only puts the sample on a queue, so no I/O
+        or Tk calls happen off the Tk thread. Every 1/max_frame_rate seconds the Tk thread drains the
+        queue, keeps only the latest value per label, and updates just the labels which changed.
+        Labels are created once and reused rather than recreated on every update. '''
+
+    max_frame_rate = 10  # Hz, UI refreshes per second.
+
+    def __init__(self, master, frame, settings):
+        self.master = master
+        self.settings = settings
+        self.fLive = Frame(frame)
+        self.fLive.configure(bg=settings.background)
+        self.fLive.pack()
+        self.__samples = queue.SimpleQueue()
+        self.__labels = dict()  # (car_no, register_name) and its Label.
+        self.__shown = dict()  # (car_no, register_name) and the text currently displayed.
+        self.__car_rows = dict()
+        self.__register_columns = dict()
+        self.__after_id = None
+
+    def add_sample(self, car_no, group, values, timestamp):
+        ''' Sample callback for Function, safe to call from any thread. '''
+        self.__samples.put((car_no, values))
+
+    def create_widgets(self, car_nos, register_names):
+        ''' Pre-create the labels for every car and register to be displayed. '''
+        for car_no in car_nos:
+            for register_name in register_names:
+                self.__label(car_no, register_name)
+
+    def __label(self, car_no, register_name):
+        key = (car_no, register_name)
+        if key not in self.__labels:
+            if car_no not in self.__car_rows:
+                self.__car_rows[car_no] = len(self.__car_rows) + 1
+                Label(self.fLive, text='Car ' + str(car_no), bg=self.settings.background, fg='white',
+                      font=self.settings.normal_font).grid(row=self.__car_rows[car_no], column=0, sticky=E)
+            if register_name not in self.__register_columns:
+                self.__register_columns[register_name] = len(self.__register_columns) + 1
+                Label(self.fLive, text=register_name, bg=self.settings.background, fg='white',
+                      font=self.settings.normal_font).grid(row=0, column=self.__register_columns[register_name])
+            self.__labels[key] = Label(self.fLive, text='-', width=8, bg=self.settings.background,
+                                       fg=self.settings.foreground, font=self.settings.normal_font)
+            self.__labels[key].grid(row=self.__car_rows[car_no], column=self.__register_columns[register_name])
+        return self.__labels[key]
+
+    def start(self):
+        if self.__after_id is None:
+            self.__after_id = self.master.after(int(1000 / LiveValues.max_frame_rate), self.__refresh)
+
+    def stop(self):
+        if self.__after_id is not None:
+            self.master.after_cancel(self.__after_id)
+            self.__after_id = None
+
+    def __refresh(self):
+        ''' Apply all samples received since the last frame in one batch, then schedule the next frame. '''
+        latest = dict()
+        while True:
+            try:
+                car_no, values = self.__samples.get_nowait()
+            except queue.Empty:
+                break
+            for register_name, value in values.items():
+                latest[(car_no, register_name)] = value
+        for key, value in latest.items():
+            text = '%.2f' % value
+            if self.__shown.get(key) != text:
+                self.__label(*key).config(text=text)
+                self.__shown[key] = text
+        self.__after_id = self.master.after(int(1000 / LiveValues.max_frame_rate), self.__refresh)
+
+
 class Viewer():
 
     operation_modes = {'1: Single Vehicle Air Leakage' : 1,
@@ -109,17 +185,21 @@ class Viewer():
                 return
         except:
             pass
-        self.settings_open = True  # For tracking widget to prevent multiple.
+        try:
+            serial_config = boot.serial_config()  # From the config cache, Communication is not created here.
+        except (OSError, KeyError, ValueError):  # Missing or invalid serial config, show the window without values.
+            serial_config = dict()
         self.baudrate = StringVar()
-        self.baudrate.set(boot.a._serial_config_dict['baudrate'])
+        self.baudrate.set(serial_config.get('baudrate', ''))
         self.parity = StringVar()
-        self.parity.set(boot.a._serial_config_dict['parity'])
+        self.parity.set(serial_config.get('parity', ''))
         self.file_path = StringVar()
         self.fg_bg_list = []
         for i in range(6):
             self.fg_bg_list.append(IntVar())
         wSettings = tk.Toplevel(self.master)
         wSettings.bind("<Destroy>", self.widget_destroyed)  # Binding to track window close.
+        self.settings_open = True  # For tracking widget to prevent multiple, set once the window exists.
         wSettings.title('View & Change Settings')
         wSettings.geometry("390x475+75+75")
         wSettings.config(bg=settings.background)
@@ -139,6 +219,10 @@ class Viewer():
         lProject_settings = Label(fSettings, text='Project: ', bg=settings.background, fg='white', font=settings.heading_font).grid(row=4, column=0, columnspan=3, sticky=NSEW)
         lUnit_numbers = Label(fSettings, text='Unit Numbers: ', bg=settings.background, fg='white', font=settings.normal_font).grid(row=5, column=0, sticky=E)
         bUnit_numbers = Button(fSettings, text='Choose File', font=settings.normal_font, command=lambda : self.unit_numbers_dialog(fSettings)).grid(row=5, column=1, columnspan=2, sticky=W)
+        self.lFile = self.create_label(fSettings, '', False, 'white')  # Row 6 labels created once, text set by unit_numbers_dialog.
+        self.lFile.grid(row=6, column=0, sticky=E)
+        self.lFile_path = self.create_label(fSettings, '', False)
+        self.lFile_path.grid(row=6, column=1, columnspan=2)
         
         lAppearance_settings = Label(fSettings, text='Appearance (0 - 255):', bg=settings.background, fg='white', font=settings.heading_font).grid(row=7, column=0, columnspan=3)
         lAppearance_fg = Label(fSettings, text='Font\nColour:', bg=settings.background, fg='white', font=settings.normal_font).grid(row=8, rowspan=3, column=0)
@@ -149,6 +233,8 @@ class Viewer():
             self.create_label(fSettings, lbl, False, 'white').grid(row=index + 8, column=1, sticky=E)
             appearance_vals.append(Entry(fSettings, textvariable=self.fg_bg_list[index]).grid(row=index + 8, column=2, sticky=W))
 
+        self.lSettings_error = self.create_label(fSettings, '', False, 'red')  # Created once, text set by _save_settings.
+        self.lSettings_error.grid(row=14, column=0, columnspan=3)
         bConfirm = Button(fSettings, text='Confirm', font=settings.normal_font, command=lambda : self._save_settings(fSettings, wSettings)).grid(row=15, column=0, columnspan=3)
         
         lSuper_user = Label(fSettings, text='Super-User: ', bg=settings.background, fg='yellow', font=settings.heading_font).grid(row=16, column=0, columnspan=3, sticky=NSEW)
@@ -162,11 +248,11 @@ class Viewer():
     def unit_numbers_dialog(self, frame):
         ''' Open file dialog for selecting specific unit number list. '''
         file_path = fd.askopenfilename()
-        lFile = Label(frame, text='File: ', bg=settings.background, fg='white', font=settings.normal_font).grid(row=6, column=0, sticky=E)
+        self.lFile.config(text='File: ')
         if file_path[-4:] != '.csv':
-            lFile_path = Label(frame, text='Invalid File Type Selected!', bg=settings.background, fg='red', font=settings.normal_font).grid(row=6, column=1, columnspan=2)
+            self.lFile_path.config(text='Invalid File Type Selected!', fg='red')
         else:
-            lFile_path = Label(frame, text=file_path[:23] + '...', bg=settings.background, fg=settings.foreground, font=settings.normal_font).grid(row=6, column=1, columnspan=2)
+            self.lFile_path.config(text=file_path[:23] + '...', fg=settings.foreground)
 
     def _save_settings(self, frame, window):
         ''' Takes the user input font colours and if valid, passes on to set the appearance. '''
@@ -184,7 +270,7 @@ class Viewer():
             self.settings_open = False  # Allow for settings to be reopened by setting False.
             window.destroy()  # Destroy passed window (wSettings)
         except:
-            self.create_label(frame, 'Invalid Colour!', False, 'red').grid(row=14, column=0, columnspan=3)
+            self.lSettings_error.config(text='Invalid Colour!')  # Reuse the one label rather than stacking a new one per attempt.
 
     def create_label(self, frame, entry_str, hdg, *opt_colour):
         ''' Method is used to create all labels.
@@ -209,13 +295,29 @@ class Viewer():
         bSettings = Button(fOther_widgets, text='Settings', bg=settings.background, fg='white', font=settings.normal_font, command=self._settings_window).pack()
     
 
+    def show_live_values(self, function, car_nos, register_names):
+        ''' Show the live values pane fed by the Function object's polling threads. '''
+        self.live_values = LiveValues(self.master, self.fMain, settings)
+        self.live_values.create_widgets(car_nos, register_names)
+        function.add_sample_callback(self.live_values.add_sample)
+        self.live_values.start()
+
     def __start_application(self):
         op_mode = self.operation_mode.get()[0]  # Get only the first value, FIGURE OUT TAKING VALUE OF DICT
 
-boot = default.Default()
 settings = Settings()
-root = Tk() #create top level widget object (window) of Tk class.
+boot = None  # default.Default, created in main() so importing this module has no side effects.
+
+
+def main():
+    global boot
+    boot = default.Default()  # Only reads master_config.csv, Communication is created on first use of boot.a.
+    root = Tk() #create top level widget object (window) of Tk class.
+
+    mainapp = Viewer(root, settings) #create instance of class and pass Top widget as 1st parameter (master). As such the root widget becomes "self".
+
+    root.mainloop()
 
-mainapp = Viewer(root, settings) #create instance of class and pass Top widget as 1st parameter (master). As such the root widget becomes "self".
 
-root.mainloop()
\ No newline at end of file
+if __name__ == '__main__':
+    main()